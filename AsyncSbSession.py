@@ -0,0 +1,500 @@
+# aiohttp is an optional library that can be found at https://docs.aiohttp.org/
+import asyncio
+import os
+import mimetypes
+import urllib.parse as urlparse
+from urllib.parse import urlencode
+from importlib.metadata import version as get_version
+from importlib.metadata import PackageNotFoundError
+
+import aiohttp
+
+from SbRetryPolicy import SbRetryPolicy
+from SbJson import get_json_codec
+
+
+#
+# asyncio counterpart of SbSession.  Every call is a coroutine, so a single event loop
+# can keep many item reads, writes, uploads and downloads in flight at once:
+#
+#     async with AsyncSbSession() as sb:
+#         items = await asyncio.gather(*[sb.get_item(i) for i in ids])
+#
+# max_concurrency caps the number of requests in flight on this session, and
+# limit_per_host caps the number of open connections to one host (0 is unlimited).
+# env may be 'beta', 'dev', None for production, or a catalog URL such as
+# 'http://127.0.0.1:8090/catalog/' to run against a local stand-in server.
+# retry_policy is an SbRetryPolicy and rate_limiter an SbRateLimiter, as for SbSession;
+# both wait with asyncio.sleep and do not hold a concurrency slot while waiting.
+# json_codec selects the JSON codec as for SbSession.
+#
+class AsyncSbSession:
+    _josso_url = None
+    _base_sb_url = None
+    _base_item_url = None
+    _base_items_url = None
+    _base_upload_file_url = None
+    _base_upload_file_temp_url = None
+    _base_download_files_url = None
+    _base_move_item_url = None
+    _base_undelete_item_url = None
+    _base_shortcut_item_url = None
+    _base_unlink_item_url = None
+    _base_directory_url = None
+    _base_person_url = None
+    _users_id = None
+    _username = None
+    _jossosessionid = None
+    _session = None
+    _semaphore = None
+    _max_item_count = 1000
+
+    #
+    # Initialize session settings.  The aiohttp session itself is created on first use,
+    # inside the running event loop.
+    #
+    def __init__(self, env=None, max_concurrency=100, limit_per_host=0, timeout=None, retry_policy=None,
+                 rate_limiter=None, json_codec=None):
+        if env == 'beta':
+            self._base_sb_url = "https://beta.sciencebase.gov/catalog/"
+            self._base_directory_url = "https://beta.sciencebase.gov/directory/"
+            self._josso_url = "https://my-beta.usgs.gov/josso/signon/usernamePasswordLogin.do"
+            self._users_id = "4f4e4772e4b07f02db47e231"
+        elif env == 'dev':
+            self._base_sb_url = "http://localhost:8090/catalog/"
+            self._base_directory_url = "https://beta.sciencebase.gov/directory/"
+            self._josso_url = "https://my-beta.usgs.gov/josso/signon/usernamePasswordLogin.do"
+        elif env and env.startswith('http'):
+            o = urlparse.urlsplit(env)
+            self._base_sb_url = env if env.endswith('/') else env + '/'
+            self._base_directory_url = "%s://%s/directory/" % (o.scheme, o.netloc)
+            self._josso_url = "%s://%s/josso/signon/usernamePasswordLogin.do" % (o.scheme, o.netloc)
+        else:
+            self._base_sb_url = "https://www.sciencebase.gov/catalog/"
+            self._base_directory_url = "https://www.sciencebase.gov/directory/"
+            self._josso_url = "https://my.usgs.gov/josso/signon/usernamePasswordLogin.do"
+            self._users_id = "4f4e4772e4b07f02db47e231"
+
+        self._base_item_url = self._base_sb_url + "item/"
+        self._base_items_url = self._base_sb_url + "items/"
+        self._base_upload_file_url = self._base_sb_url + "file/uploadAndUpsertItem/"
+        self._base_download_files_url = self._base_sb_url + "file/get/"
+        self._base_upload_file_temp_url = self._base_sb_url + "file/upload/"
+        self._base_move_item_url = self._base_items_url + "move/"
+        self._base_undelete_item_url = self._base_item_url + "undelete/"
+        self._base_shortcut_item_url = self._base_items_url + "addLink/"
+        self._base_unlink_item_url = self._base_items_url + "unlink/"
+        self._base_person_url = self._base_directory_url + "person/"
+
+        self._max_concurrency = max_concurrency
+        self._limit_per_host = limit_per_host
+        self._timeout = timeout
+        self._retry_policy = retry_policy if retry_policy is not None else SbRetryPolicy()
+        self._rate_limiter = rate_limiter
+        self._json = get_json_codec(json_codec)
+        self._params = {}
+        self._headers = {'Accept': 'application/json'}
+        pysb_agent = 'sciencebase-pysb-async'
+        try:
+            pysb_agent += '/%s' % get_version("pysb")
+        except PackageNotFoundError:
+            pass
+        self._headers['User-Agent'] = 'aiohttp/%s %s' % (aiohttp.__version__, pysb_agent)
+
+    async def __aenter__(self):
+        self._get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    #
+    # Close the underlying aiohttp session and its connections
+    #
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    #
+    # Log into ScienceBase
+    #
+    async def login(self, username, password):
+        # Save username
+        self._username = username
+
+        # Login and save JOSSO Session ID
+        session = self._get_session()
+        async with session.post(self._josso_url, params={'josso_cmd': 'josso', 'josso_username': username,
+                                                         'josso_password': password}) as ret:
+            await ret.read()
+        jossosessionid = None
+        for cookie in session.cookie_jar:
+            if cookie.key == 'JOSSO_SESSIONID':
+                jossosessionid = cookie.value
+        if not jossosessionid:
+            raise Exception("Login failed")
+        self._jossosessionid = jossosessionid
+        self._params = {'josso': self._jossosessionid}
+        self._headers['MYUSGS-JOSSO-SESSION-ID'] = self._jossosessionid
+        return self
+
+    #
+    # Log out of ScienceBase
+    #
+    async def logout(self):
+        await self._request('POST', self._base_sb_url + 'j_spring_security_logout', check=False)
+        self._get_session().cookie_jar.clear()
+        self._params = {}
+        self._headers.pop('MYUSGS-JOSSO-SESSION-ID', None)
+        self._jossosessionid = None
+
+    #
+    # Return whether the session is logged in and active in ScienceBase
+    #
+    async def is_logged_in(self):
+        return (await self.get_session_info())['isLoggedIn']
+
+    #
+    # Ping ScienceBase.  A very low-cost operation to determine whether ScienceBase is available
+    #
+    async def ping(self):
+        return await self.get_json(self._base_item_url + 'ping')
+
+    #
+    # Return ScienceBase Josso session info
+    #
+    async def get_session_info(self):
+        return await self.get_json(self._base_sb_url + 'jossoHelper/sessionInfo?includeJossoSessionId=true')
+
+    #
+    # Get the ScienceBase Item JSON with the given ID
+    #
+    async def get_item(self, itemid, params=None):
+        return await self._request_json('GET', self._base_item_url + itemid, params=params)
+
+    #
+    # Create a new Item in ScienceBase
+    #
+    async def create_item(self, item_json):
+        return await self._request_json('POST', self._base_item_url, data=self._json.encode(item_json))
+
+    #
+    # Update an existing ScienceBase Item
+    #
+    async def update_item(self, item_json):
+        return await self._request_json('PUT', self._base_item_url + item_json['id'], data=self._json.encode(item_json))
+
+    #
+    # Update multiple ScienceBase items (takes an array of items)
+    #
+    async def update_items(self, items_json):
+        return await self._request_json('PUT', self._base_items_url, data=self._json.encode(items_json))
+
+    #
+    # Delete an existing ScienceBase Item
+    #
+    async def delete_item(self, item_json):
+        await self._request('DELETE', self._base_item_url + item_json['id'], data=self._json.encode(item_json))
+        return True
+
+    #
+    # Delete multiple ScienceBase Items, in chunks of _max_item_count sent concurrently
+    #
+    async def delete_items(self, itemIds):
+        chunks = [[{'id': itemId} for itemId in itemIds[i:i + self._max_item_count]]
+                  for i in range(0, len(itemIds), self._max_item_count)]
+        await asyncio.gather(*[self._request('DELETE', self._base_items_url, data=self._json.encode(ids_json))
+                               for ids_json in chunks])
+        return True
+
+    #
+    # Move an existing ScienceBase Item under a new parent
+    #
+    async def move_item(self, itemid, parentid):
+        return await self._request_json('POST', self._base_move_item_url,
+                                        params={'itemId': itemid, 'destId': parentid})
+
+    #
+    # Search for ScienceBase items
+    #
+    async def find_items(self, params):
+        return await self._request_json('GET', self._base_items_url, params=params)
+
+    #
+    # Get the next set of items from the search
+    #
+    async def next(self, items):
+        ret_val = None
+        if 'nextlink' in items:
+            ret_val = await self._request_json('GET', self._remove_josso_param(items['nextlink']['url']))
+        return ret_val
+
+    #
+    # Get the previous set of items from the search
+    #
+    async def previous(self, items):
+        ret_val = None
+        if 'prevlink' in items:
+            ret_val = await self._request_json('GET', self._remove_josso_param(items['prevlink']['url']))
+        return ret_val
+
+    #
+    # Iterate over every ScienceBase item matching a search, one item at a time.  The next
+    # page is requested as soon as the current one arrives, so the round trip overlaps
+    # with the caller's work on the current page.
+    #
+    async def iter_items(self, params):
+        items = await self.find_items(params)
+        while items and 'items' in items:
+            pending = asyncio.ensure_future(self.next(items)) if 'nextlink' in items else None
+            try:
+                for item in items['items']:
+                    yield item
+            except BaseException:
+                if pending is not None:
+                    pending.cancel()
+                raise
+            items = await pending if pending is not None else None
+
+    #
+    # Get the JSON response of the given URL
+    #
+    async def get_json(self, url):
+        return await self._request_json('GET', url)
+
+    #
+    # Get the text response of the given URL
+    #
+    async def get(self, url):
+        status, headers, body = await self._request('GET', url)
+        return body.decode('utf-8', 'replace')
+
+    #
+    # Upload multiple files and create or update an Item in ScienceBase.  Files are
+    # streamed from disk rather than read into memory.
+    #
+    async def upload_files_and_upsert_item(self, item, filenames, scrape_file=True):
+        for filename in filenames:
+            if not os.access(filename, os.F_OK):
+                raise Exception("File not found: " + filename)
+        files = [open(filename, 'rb') for filename in filenames]
+        try:
+            data = aiohttp.FormData()
+            data.add_field('item', self._json.encode(item).decode('utf-8'))
+            if 'id' in item and item['id']:
+                data.add_field('id', item['id'])
+            for f in files:
+                data.add_field('file', f, filename=os.path.basename(f.name))
+            params = {} if scrape_file is True else {'scrapeFile': 'false'}
+            return await self._request_json('POST', self._base_upload_file_url, params=params, data=data,
+                                            nbytes=sum(os.path.getsize(filename) for filename in filenames))
+        finally:
+            for f in files:
+                f.close()
+
+    #
+    # Upload multiple files and update an existing Item in ScienceBase
+    #
+    async def upload_files_and_update_item(self, item, filenames, scrape_file=True):
+        return await self.upload_files_and_upsert_item(item, filenames, scrape_file)
+
+    #
+    # Upload multiple files and create a new Item in ScienceBase
+    #
+    async def upload_files_and_create_item(self, parentid, filenames, scrape_file=True):
+        return await self.upload_files_and_upsert_item({'parentId': parentid}, filenames, scrape_file)
+
+    #
+    # Upload a file to an existing Item in ScienceBase
+    #
+    async def upload_file_to_item(self, item, filename, scrape_file=True):
+        return await self.upload_files_and_upsert_item(item, [filename], scrape_file)
+
+    #
+    # Upload a file and create a new Item in ScienceBase
+    #
+    async def upload_file_and_create_item(self, parentid, filename, scrape_file=True):
+        return await self.upload_files_and_create_item(parentid, [filename], scrape_file)
+
+    #
+    # Upload a file to the ScienceBase temporary staging area
+    #
+    async def upload_file(self, filename, mimetype=None):
+        if not os.access(filename, os.F_OK):
+            raise Exception("File not found: " + filename)
+        if None == mimetype:
+            mimetype = mimetypes.guess_type(filename)[0]
+        with open(filename, 'rb') as f:
+            data = aiohttp.FormData()
+            data.add_field('files[]', f, filename=os.path.basename(filename),
+                           content_type=mimetype or 'application/octet-stream')
+            return await self._request_json('POST', self._base_upload_file_temp_url, data=data,
+                                            nbytes=os.path.getsize(filename))
+
+    #
+    # Download file from URL, streaming it to disk in chunk_size pieces
+    #
+    async def download_file(self, url, local_filename, destination='.', chunk_size=1024 * 1024):
+        complete_name = os.path.join(destination, local_filename)
+        attempt = 0
+        while True:
+            await self._wait_for_rate_limiter()
+            try:
+                async with self._get_semaphore():
+                    async with self._get_session().get(url, params=self._params, headers=self._headers) as r:
+                        self._retry_policy.record(r.status)
+                        delay = self._retry_policy.next_delay('GET', attempt, status=r.status,
+                                                              retry_after=r.headers.get('Retry-After'))
+                        if delay is None:
+                            if r.status != 200:
+                                self._check_errors(r.status, await r.text())
+                            with open(complete_name, 'wb') as f:
+                                async for chunk in r.content.iter_chunked(chunk_size):
+                                    # The body is charged to the byte bucket as it arrives
+                                    await self._wait_for_rate_limiter(len(chunk), count=0)
+                                    f.write(chunk)
+                            return complete_name
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self._retry_policy.record(error=True)
+                delay = self._retry_policy.next_delay('GET', attempt, error=True)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    #
+    # Download the individual files attached to a ScienceBase Item concurrently.  Returns
+    # the list of local file names in the order of get_item_file_info.
+    #
+    async def get_item_files(self, item, destination='.'):
+        file_info = self.get_item_file_info(item)
+        return await asyncio.gather(*[self.download_file(finfo['url'], finfo['name'], destination)
+                                      for finfo in file_info])
+
+    #
+    # Download all files from a ScienceBase Item as a zip
+    #
+    async def get_item_files_zip(self, item, destination='.'):
+        if not self.get_item_file_info(item):
+            return None
+        return await self.download_file(self._base_download_files_url + item['id'], item['id'] + ".zip",
+                                        destination)
+
+    #
+    # Retrieve file information from a ScienceBase Item.  Returns a list of dictionaries
+    # containing url, name, size and dateUploaded of each file.
+    #
+    def get_item_file_info(self, item):
+        retval = []
+        if item:
+            file_lists = [item.get('files', [])] + [facet.get('files', []) for facet in item.get('facets', [])]
+            for files in file_lists:
+                for f in files:
+                    retval.append(dict((k, f[k]) for k in ('url', 'name', 'size', 'dateUploaded') if k in f))
+        return retval
+
+    #
+    # Create the aiohttp session on first use
+    #
+    def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_concurrency, limit_per_host=self._limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                                  timeout=aiohttp.ClientTimeout(total=self._timeout))
+        return self._session
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._semaphore
+
+    #
+    # Send a request, holding a concurrency slot until the whole body has been read.
+    # Returns the status code, headers and body bytes.
+    #
+    # Requests are retried according to the session's retry policy, except form uploads
+    # whose body cannot be sent twice.  nbytes is the size of the body for the rate
+    # limiter, where data is a form whose size is not known here.
+    #
+    async def _request(self, method, url, params=None, data=None, check=True, nbytes=None):
+        all_params = dict(self._params)
+        if params:
+            all_params.update(params)
+        replayable = not isinstance(data, aiohttp.FormData)
+        attempt = 0
+        while True:
+            if nbytes is None:
+                nbytes = len(data) if isinstance(data, (bytes, str)) else 0
+            await self._wait_for_rate_limiter(nbytes)
+            try:
+                async with self._get_semaphore():
+                    async with self._get_session().request(method, url, params=all_params, data=data,
+                                                           headers=self._headers) as r:
+                        body = await r.read()
+                        status, headers = r.status, r.headers
+                if self._rate_limiter is not None:
+                    self._rate_limiter.consume(len(body))
+                self._retry_policy.record(status)
+                delay = self._retry_policy.next_delay(method, attempt, status=status,
+                                                      retry_after=headers.get('Retry-After')) if replayable else None
+                if delay is None:
+                    if check:
+                        self._check_errors(status, body.decode('utf-8', 'replace'))
+                    return status, headers, body
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self._retry_policy.record(error=True)
+                delay = self._retry_policy.next_delay(method, attempt, error=True) if replayable else None
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    #
+    # Wait until the rate limiter, if any, lets a request sending nbytes bytes go ahead;
+    # see SbRateLimiter.acquire for count
+    #
+    async def _wait_for_rate_limiter(self, nbytes=0, count=1):
+        if self._rate_limiter is not None:
+            wait = self._rate_limiter.try_acquire(nbytes, count)
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self._rate_limiter.try_acquire(nbytes, count)
+
+    #
+    # Return the retry counters of the session's retry policy, see SbRetryPolicy.stats
+    #
+    def retry_stats(self):
+        return self._retry_policy.stats()
+
+    #
+    # Send a request and return the parsed JSON response
+    #
+    async def _request_json(self, method, url, params=None, data=None, nbytes=None):
+        status, headers, body = await self._request(method, url, params=params, data=data, nbytes=nbytes)
+        try:
+            return self._json.decode(body)
+        except ValueError:
+            raise Exception("Error parsing JSON response: " + body.decode('utf-8', 'replace'))
+
+    #
+    # Check the status code of the response
+    #
+    def _check_errors(self, status, text):
+        if (status == 404):
+            raise Exception("Resource not found, or user does not have access")
+        elif (status == 401):
+            raise Exception("Unauthorized access")
+        elif (status == 429):
+            raise Exception("Too many requests")
+        elif (status != 200):
+            raise Exception("Other HTTP error: " + str(status) + ": " + text)
+
+    #
+    # Remove josso parameter from URL
+    #
+    def _remove_josso_param(self, url):
+        o = urlparse.urlsplit(url)
+        q = [x for x in urlparse.parse_qsl(o.query) if "josso" not in x]
+        return urlparse.urlunsplit((o.scheme, o.netloc, o.path, urlencode(q), o.fragment))
@@ -0,0 +1,339 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from urllib.request import Request, urlopen
+
+from SbMockServer import SbMockServer
+from SbSession import SbSession, SbSessionPool
+
+
+#
+# Throughput, latency and memory benchmarks for SbSession against SbMockServer.
+#
+# The stand-in server runs in a separate process, so that its own work and memory do
+# not count towards the client's.  Each scenario is timed over several runs and then
+# run once more under tracemalloc for its peak Python memory use.  Results are printed,
+# and written as JSON with --output; --compare reports the change from an earlier
+# results file.
+#
+#     python SbBenchmark.py --latency 0.005 --output after.json --compare before.json
+#     python SbBenchmark.py --scenarios search_paging,download --repeat 5
+#
+# The startup scenario runs fresh interpreters that import SbSession, create a session
+# and get one item, reporting the median time taken by each step.
+#
+# Each scenario is a function taking the session, a _Benchmark giving access to the
+# server, and the scratch directory, and returning the number of operations and bytes
+# it transferred.  Untimed set-up is done in a function of the same name with a
+# _setup suffix, whose return value is passed as a fourth argument.
+#
+class _Benchmark(object):
+    def __init__(self, url, args):
+        self.url = url
+        self.args = args
+        self._control = url.replace('/catalog/', '/mock/')
+
+    def control(self, command, args=None):
+        request = Request(self._control + command, data=json.dumps(args or {}).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        return json.loads(urlopen(request).read().decode('utf-8'))
+
+    def seed(self, count, files=0, file_size=0):
+        parent = 'p%023d' % int(time.time() * 1000000 % 1e15)
+        ids = self.control('seed', {'parentId': parent, 'count': count, 'files': files, 'file_size': file_size})
+        return parent, ids['ids']
+
+
+def item_get_setup(sb, bench, scratch):
+    return bench.seed(1)[1][0]
+
+
+def item_get(sb, bench, scratch, itemid):
+    n = bench.args.items // 5
+    for i in range(n):
+        sb.get_item(itemid)
+    return n, 0
+
+
+def item_get_parallel_setup(sb, bench, scratch):
+    return bench.seed(bench.args.items)[1]
+
+
+def item_get_parallel(sb, bench, scratch, ids):
+    pool = SbSessionPool(sb, max_workers=bench.args.workers)
+    try:
+        pool.map(lambda session, itemid: session.get_item(itemid), ids)
+    finally:
+        pool.close()
+    return len(ids), 0
+
+
+def item_crud(sb, bench, scratch, setup=None):
+    n = bench.args.items // 10
+    for i in range(n):
+        item = sb.create_item({'title': 'Benchmark %d' % i})
+        item['title'] += ' updated'
+        sb.update_item(item)
+        sb.delete_item(item)
+    return 3 * n, 0
+
+
+def search_paging_setup(sb, bench, scratch):
+    return bench.seed(bench.args.items * 5)[0]
+
+
+def search_paging(sb, bench, scratch, parent, prefetch=0, stream=False):
+    params = {'filter': 'parentId=' + parent, 'max': bench.args.page_size, 'fields': 'title'}
+    n = sum(1 for item in sb.iter_items(params, prefetch=prefetch, stream=stream))
+    return n, 0
+
+
+search_paging_prefetch_setup = search_paging_setup
+
+
+def search_paging_prefetch(sb, bench, scratch, parent):
+    return search_paging(sb, bench, scratch, parent, prefetch=2)
+
+
+search_paging_stream_setup = search_paging_setup
+
+
+def search_paging_stream(sb, bench, scratch, parent):
+    return search_paging(sb, bench, scratch, parent, prefetch=2, stream=True)
+
+
+def bulk_update_setup(sb, bench, scratch):
+    return bench.seed(bench.args.items)[1]
+
+
+def bulk_update(sb, bench, scratch, ids):
+    report = sb.bulk_update_items([{'id': itemid, 'title': 'updated'} for itemid in ids],
+                                  max_count=100, workers=bench.args.workers)
+    if report['failed']:
+        raise Exception("Bulk update failed: %s" % report['failed'][:3])
+    return len(ids), 0
+
+
+update_loop_setup = bulk_update_setup
+
+
+def update_loop(sb, bench, scratch, ids):
+    ids = ids[:bench.args.items // 5]
+    for itemid in ids:
+        sb.update_item({'id': itemid, 'title': 'updated'})
+    return len(ids), 0
+
+
+def upload_setup(sb, bench, scratch):
+    filenames = []
+    block = os.urandom(1024 * 1024)
+    for i in range(bench.args.files):
+        filename = os.path.join(scratch, 'upload%d.bin' % i)
+        with open(filename, 'wb') as f:
+            for j in range(bench.args.file_mb):
+                f.write(block)
+        filenames.append(filename)
+    return bench.seed(1)[1][0], filenames
+
+
+def upload(sb, bench, scratch, setup, part_size=None):
+    itemid, filenames = setup
+    sb.upload_files_and_upsert_item({'id': itemid}, filenames, part_size=part_size)
+    return len(filenames), sum(os.path.getsize(filename) for filename in filenames)
+
+
+upload_parts_setup = upload_setup
+
+
+def upload_parts(sb, bench, scratch, setup):
+    return upload(sb, bench, scratch, setup, part_size=4 * 1024 * 1024)
+
+
+def download_setup(sb, bench, scratch):
+    parent, ids = bench.seed(1, files=1, file_size=bench.args.files * bench.args.file_mb * 1024 * 1024)
+    return sb.get_item(ids[0])['files'][0]
+
+
+def download(sb, bench, scratch, finfo):
+    sb.download_file(finfo['url'], finfo['name'], scratch)
+    return 1, finfo['size']
+
+
+def download_parallel_setup(sb, bench, scratch):
+    parent, ids = bench.seed(1, files=bench.args.files, file_size=bench.args.file_mb * 1024 * 1024)
+    return sb.get_item_file_info(sb.get_item(ids[0]))
+
+
+def download_parallel(sb, bench, scratch, file_info):
+    for result in sb.download_files(file_info, scratch, workers=bench.args.workers):
+        if result['error'] is not None:
+            raise Exception("Download failed: " + result['error'])
+    return len(file_info), sum(f['size'] for f in file_info)
+
+
+_startup_script = '''
+import json, sys, time
+start = time.time()
+import SbSession
+imported = time.time()
+sb = SbSession.SbSession(sys.argv[1])
+constructed = time.time()
+sb.get_item(sys.argv[2])
+print(json.dumps([imported - start, constructed - imported, time.time() - constructed]))
+'''
+
+
+#
+# Time importing SbSession, creating a session and its first request in new interpreters
+#
+def run_startup(url, bench):
+    itemid = bench.seed(1)[1][0]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__))] +
+                                        ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    runs = []
+    for i in range(max(bench.args.repeat, 1) * 3):
+        output = subprocess.check_output([sys.executable, '-c', _startup_script, url, itemid], env=env)
+        runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    def median(values):
+        return sorted(values)[len(values) // 2]
+
+    import_time, construct_time, request_time = [median(column) for column in zip(*runs)]
+    total = median([sum(run) for run in runs])
+    return {'scenario': 'startup', 'runs': [sum(run) for run in runs], 'median_seconds': total, 'ops': 1,
+            'ops_per_second': 1 / total, 'bytes': 0, 'mb_per_second': None, 'requests': 1, 'retries': 0,
+            'peak_memory': 0, 'import_seconds': import_time, 'construct_seconds': construct_time,
+            'first_request_seconds': request_time}
+
+
+SCENARIOS = ['startup', 'item_get', 'item_get_parallel', 'item_crud', 'search_paging', 'search_paging_prefetch',
+             'search_paging_stream', 'bulk_update', 'update_loop', 'upload', 'upload_parts', 'download',
+             'download_parallel']
+
+
+def run_scenario(name, url, bench, scratch):
+    if bench.args.repeat < 1:
+        raise Exception("repeat must be at least 1")
+    func = globals()[name]
+    setup = globals().get(name + '_setup')
+    timings = []
+    ops = nbytes = 0
+    requests = retries = 0
+    for i in range(bench.args.repeat + 1):
+        sb = SbSession(url, json_codec=bench.args.json_codec)
+        arg = setup(sb, bench, scratch) if setup else None
+        measure_memory = i == bench.args.repeat
+        if measure_memory:
+            tracemalloc.start()
+        start = time.time()
+        ops, nbytes = func(sb, bench, scratch, arg)
+        elapsed = time.time() - start
+        if measure_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            timings.append(elapsed)
+            stats = sb.stats()
+            requests = sum(s['count'] for s in stats.values())
+            retries = sum(s['retries'] for s in stats.values())
+        for entry in os.listdir(scratch):
+            if not entry.startswith('upload'):
+                os.remove(os.path.join(scratch, entry))
+    median = sorted(timings)[len(timings) // 2]
+    return {'scenario': name, 'runs': timings, 'median_seconds': median, 'ops': ops,
+            'ops_per_second': ops / median if median else None, 'bytes': nbytes,
+            'mb_per_second': nbytes / median / 1024 / 1024 if median and nbytes else None,
+            'requests': requests, 'retries': retries, 'peak_memory': peak}
+
+
+#
+# Serve the stand-in in this process until terminated, sending its URL back on conn
+#
+def _serve(conn, settings):
+    server = SbMockServer(**settings)
+    conn.send(server.url)
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark SbSession against a local ScienceBase stand-in')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated, from: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each scenario')
+    parser.add_argument('--items', type=int, default=1000, help='scale of the item scenarios')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--files', type=int, default=4, help='files per upload or download')
+    parser.add_argument('--file-mb', type=int, default=8, help='size of each file in MB')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--json-codec', default='json', help="'json' or 'orjson'")
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the server adds to every response')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--throttle-every', type=int, default=0, help='the server answers every Nth request with 429')
+    parser.add_argument('--bandwidth', type=int, help='bytes per second of each download')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario: ' + name)
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    settings = {'latency': args.latency, 'jitter': args.jitter, 'throttle_every': args.throttle_every,
+                'bandwidth': args.bandwidth}
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(child_conn, settings))
+    server.daemon = True
+    server.start()
+    url = parent_conn.recv()
+    bench = _Benchmark(url, args)
+    scratch = tempfile.mkdtemp(prefix='sbbenchmark')
+    results = []
+    try:
+        for name in names:
+            result = run_startup(url, bench) if name == 'startup' else run_scenario(name, url, bench, scratch)
+            results.append(result)
+            print('%-24s %8.3fs  %10.1f ops/s  %8s MB/s  %6d requests  peak %.1f MB' % (
+                name, result['median_seconds'], result['ops_per_second'] or 0,
+                '%.1f' % result['mb_per_second'] if result['mb_per_second'] else '-',
+                result['requests'], result['peak_memory'] / 1024.0 / 1024.0))
+            if name == 'startup':
+                print('%-24s import %.1f ms, session %.2f ms, first request %.1f ms' % (
+                    '', 1000 * result['import_seconds'], 1000 * result['construct_seconds'],
+                    1000 * result['first_request_seconds']))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        server.terminate()
+
+    output = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'python': sys.version.split()[0],
+                       'platform': platform.platform(), 'settings': vars(args)},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            before = dict((r['scenario'], r) for r in json.load(f)['results'])
+        print('\nChange from ' + args.compare)
+        for result in results:
+            old = before.get(result['scenario'])
+            if old:
+                print('%-24s time %+7.1f%%  peak memory %+7.1f%%' % (
+                    result['scenario'], 100.0 * (result['median_seconds'] / old['median_seconds'] - 1),
+                    100.0 * (float(result['peak_memory']) / old['peak_memory'] - 1) if old['peak_memory'] else 0))
+    return output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import threading
+import time
+
+import requests
+import urllib3
+
+from SbMetrics import SbMetrics
+
+
+#
+# requests.Session that retries requests according to an SbRetryPolicy, and waits for
+# an SbRateLimiter, if any, before each attempt.  Requests whose body is a stream or
+# open files are sent once, since their body cannot be replayed.
+#
+# The limiter's byte bucket is charged with the request body before it is sent where
+# its size is known (including files= uploads), and otherwise as the body is read out,
+# and with streamed responses as they are read, so long transfers are slowed to the
+# byte rate as they go.  Responses read in full are charged once received.
+#
+class _SbRequestsSession(requests.Session):
+    def __init__(self, retry_policy, rate_limiter=None, timeout=None, metrics=None):
+        requests.Session.__init__(self)
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.metrics = metrics
+
+    def request(self, method, url, **kwargs):
+        data = kwargs.get('data')
+        replayable = not kwargs.get('files') and not hasattr(data, 'read') and not hasattr(data, '__next__')
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        policy = self.retry_policy
+        limiter = self.rate_limiter
+        if limiter is not None:
+            nbytes = _body_size(data, kwargs.get('files'))
+            if nbytes is None:
+                # A stream of unknown length, charged as it is sent
+                data = kwargs['data'] = _metered_body(data, limiter)
+                nbytes = 0
+        attempt = 0
+        start = time.time()
+        while True:
+            if limiter is not None:
+                limiter.acquire(nbytes)
+            _connect_time.value = 0.0
+            attempt_start = time.time()
+            try:
+                response = requests.Session.request(self, method, url, **kwargs)
+                if limiter is not None:
+                    if kwargs.get('stream'):
+                        _meter_response(response, limiter)
+                    else:
+                        limiter.consume(len(response.content))
+            except Exception as e:
+                retry = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+                if retry:
+                    policy.record(error=True)
+                delay = policy.next_delay(method, attempt, error=True) if retry and replayable else None
+                if delay is None:
+                    if self.metrics is not None:
+                        self._record(method, url, None, data, start, attempt_start, attempt, e)
+                    raise
+            else:
+                policy.record(response.status_code)
+                delay = policy.next_delay(method, attempt, status=response.status_code,
+                                          retry_after=response.headers.get('Retry-After')) if replayable else None
+                if delay is None:
+                    if self.metrics is not None:
+                        self._record(method, url, response, data, start, attempt_start, attempt,
+                                     stream=kwargs.get('stream'))
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    #
+    # Send the event for a finished request to the metrics.  Streamed responses are
+    # recorded when closed, once their body has been read.
+    #
+    def _record(self, method, url, response, data, start, attempt_start, retries, error=None, stream=False):
+        connect = _connect_time.value
+        event = {'method': method.upper(), 'url': url, 'endpoint': SbMetrics.endpoint_class(method.upper(), url),
+                 'status': None, 'bytes_out': None, 'bytes_in': 0, 'connect': connect, 'ttfb': None,
+                 'transfer': None, 'elapsed': None, 'retries': retries, 'error': None}
+        if response is None:
+            event.update({'error': str(error), 'elapsed': time.time() - start,
+                          'bytes_out': len(data) if isinstance(data, (bytes, str)) else getattr(data, 'len', None)})
+            self.metrics.record(event)
+            return
+        body = response.request.body
+        headers_time = response.elapsed.total_seconds()
+        event.update({'status': response.status_code, 'ttfb': max(headers_time - connect, 0.0),
+                      'bytes_out': 0 if body is None else (len(body) if isinstance(body, (bytes, str))
+                                                           else getattr(body, 'len', None))})
+
+        def finish(transfer):
+            tell = getattr(response.raw, 'tell', None)
+            event['bytes_in'] = tell() if tell is not None else len(response.content or b'')
+            event['transfer'] = max(transfer, 0.0)
+            event['elapsed'] = time.time() - start
+            self.metrics.record(event)
+
+        if not stream:
+            finish(time.time() - attempt_start - headers_time)
+            return
+        returned = time.time()
+        close = response.close
+
+        def close_and_record():
+            if event['elapsed'] is None:
+                finish(time.time() - returned)
+            close()
+        response.close = close_and_record
+
+
+#
+# Size in bytes of a request body given as requests' data and files arguments, or None
+# for a stream whose length is not known up front
+#
+def _body_size(data, files):
+    nbytes = 0
+    if files:
+        for name, value in (files.items() if isinstance(files, dict) else files):
+            if isinstance(value, (tuple, list)):
+                value = value[1]
+            nbytes += _value_size(value)
+    if data is None:
+        return nbytes
+    if isinstance(data, dict):
+        return nbytes + sum(_value_size(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return nbytes + sum(_value_size(value) for name, value in data)
+    if isinstance(data, (bytes, str)):
+        return nbytes + len(data)
+    if getattr(data, 'len', None) is not None or hasattr(data, 'fileno'):
+        return nbytes + requests.utils.super_len(data)
+    return None
+
+
+def _value_size(value):
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if hasattr(value, 'read') or getattr(value, 'len', None) is not None:
+        return requests.utils.super_len(value)
+    return len(str(value))
+
+
+#
+# Wrap a request body stream so that the limiter's byte bucket is charged as it is read
+#
+def _metered_body(body, limiter):
+    if hasattr(body, 'read'):
+        return _MeteredReader(body, limiter)
+    return _metered_chunks(body, limiter)
+
+
+def _metered_chunks(chunks, limiter):
+    for chunk in chunks:
+        limiter.acquire(len(chunk), count=0)
+        yield chunk
+
+
+class _MeteredReader(object):
+    def __init__(self, body, limiter):
+        self._body = body
+        self._limiter = limiter
+
+    def read(self, size=-1):
+        chunk = self._body.read(size)
+        if chunk:
+            self._limiter.acquire(len(chunk), count=0)
+        return chunk
+
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 1024), b'')
+
+
+#
+# Charge the limiter's byte bucket with a streamed response body as it is read, whether
+# through read() or, for chunked responses, read_chunked()
+#
+def _meter_response(response, limiter):
+    raw = response.raw
+    read = raw.read
+    read_chunked = getattr(raw, 'read_chunked', None)
+
+    def metered_read(*args, **kwargs):
+        chunk = read(*args, **kwargs)
+        if chunk:
+            limiter.acquire(len(chunk), count=0)
+        return chunk
+    raw.read = metered_read
+
+    if read_chunked is not None:
+        def metered_read_chunked(*args, **kwargs):
+            for chunk in read_chunked(*args, **kwargs):
+                limiter.acquire(len(chunk), count=0)
+                yield chunk
+        raw.read_chunked = metered_read_chunked
+
+
+#
+# Seconds the current thread has spent opening connections during its current request
+#
+_connect_time = threading.local()
+_connect_time.value = 0.0
+
+
+class _TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        start = time.time()
+        try:
+            urllib3.connection.HTTPConnection.connect(self)
+        finally:
+            _connect_time.value = getattr(_connect_time, 'value', 0.0) + time.time() - start
+
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        start = time.time()
+        try:
+            urllib3.connection.HTTPSConnection.connect(self)
+        finally:
+            _connect_time.value = getattr(_connect_time, 'value', 0.0) + time.time() - start
+
+
+class _TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+#
+# HTTPAdapter whose connections record the time spent connecting, for SbMetrics
+#
+class _SbHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool,
+                                                   'https': _TimedHTTPSConnectionPool}
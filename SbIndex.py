@@ -0,0 +1,188 @@
+import json
+import sqlite3
+
+from SbItem import item_modified
+
+
+#
+# Local SQLite index of ScienceBase item metadata for offline queries.
+#
+# index_tree() loads every item below a root item into normalized tables:
+#
+#     items(id, title, parent_id, modified, min_x, min_y, max_x, max_y, json)
+#     ancestors(item_id, ancestor_id)      every ancestor of every item
+#     files(item_id, name, size, url, date_uploaded)
+#     extents(item_id, extent_id)
+#
+# Refreshing is incremental: the tree is listed with only modification dates, and only
+# new or changed items are fetched in full (with get_items), while items that have gone
+# are removed.  Questions such as "which items under X have NetCDF files over 1 GB" are
+# then answered locally:
+#
+#     index = SbIndex('sciencebase.db', SbSession())
+#     index.index_tree(root_id)
+#     index.find_files(under=root_id, extension='.nc', min_size=2 ** 30)
+#
+class SbIndex(object):
+    _fields = 'title,parentId,provenance,dateModified,files,facets,extents,spatial'
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS items (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            parent_id TEXT,
+            modified TEXT,
+            min_x REAL, min_y REAL, max_x REAL, max_y REAL,
+            json TEXT
+        );
+        CREATE INDEX IF NOT EXISTS items_parent ON items (parent_id);
+        CREATE TABLE IF NOT EXISTS ancestors (
+            item_id TEXT,
+            ancestor_id TEXT,
+            PRIMARY KEY (item_id, ancestor_id)
+        );
+        CREATE INDEX IF NOT EXISTS ancestors_ancestor ON ancestors (ancestor_id);
+        CREATE TABLE IF NOT EXISTS files (
+            item_id TEXT,
+            name TEXT,
+            size INTEGER,
+            url TEXT,
+            date_uploaded TEXT
+        );
+        CREATE INDEX IF NOT EXISTS files_item ON files (item_id);
+        CREATE TABLE IF NOT EXISTS extents (
+            item_id TEXT,
+            extent_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS extents_item ON extents (item_id);
+        CREATE INDEX IF NOT EXISTS extents_extent ON extents (extent_id);
+    """
+
+    def __init__(self, path, session=None):
+        self._sb = session
+        self._db = sqlite3.connect(path)
+        self._db.executescript(self._schema)
+
+    def close(self):
+        self._db.close()
+
+    #
+    # Load or refresh the index with root_id and all items below it (excluding shortcuts).
+    # Returns the number of items added, updated and deleted.
+    #
+    def index_tree(self, root_id):
+        summary = {'added': 0, 'updated': 0, 'deleted': 0}
+        listed = {}
+        root = self._sb.get_item(root_id, {'fields': 'parentId,provenance,dateModified'})
+        listed[root_id] = item_modified(root)
+        params = {'filter': 'ancestorsExcludingLinks=' + root_id, 'fields': 'provenance,dateModified',
+                  'max': self._sb._max_item_count}
+        for item in self._sb.iter_items(params):
+            listed[item['id']] = item_modified(item)
+
+        known = dict(self._db.execute(
+            "SELECT id, modified FROM items WHERE id = ? OR id IN (SELECT item_id FROM ancestors WHERE ancestor_id = ?)",
+            (root_id, root_id)))
+        changed = [itemid for itemid, modified in listed.items()
+                   if itemid not in known or modified is None or known[itemid] != modified]
+        gone = [itemid for itemid in known if itemid not in listed]
+
+        items, missing = self._sb.get_items(changed, fields=self._fields) if changed else ([], [])
+        with self._db:
+            for item in items:
+                summary['updated' if item['id'] in known else 'added'] += 1
+                self._store(item)
+            for itemid in gone + missing:
+                if itemid in known:
+                    summary['deleted'] += 1
+                self._remove(itemid)
+            self._rebuild_ancestors()
+        return summary
+
+    #
+    # Run an SQL query against the index and return the rows
+    #
+    def query(self, sql, params=()):
+        return self._db.execute(sql, params).fetchall()
+
+    #
+    # Return the IDs of the children of the given item
+    #
+    def children(self, itemid):
+        return [row[0] for row in self._db.execute("SELECT id FROM items WHERE parent_id = ?", (itemid,))]
+
+    #
+    # Return the IDs of all descendants of the given item
+    #
+    def descendants(self, itemid):
+        return [row[0] for row in self._db.execute("SELECT item_id FROM ancestors WHERE ancestor_id = ?", (itemid,))]
+
+    #
+    # Return the item JSON stored for the given ID, or None
+    #
+    def get_item(self, itemid):
+        row = self._db.execute("SELECT json FROM items WHERE id = ?", (itemid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    #
+    # Find files, optionally only those on items under the given item, with the given
+    # file name extension, or of at least min_size bytes.  Returns (item_id, name, size,
+    # url) rows, largest first.
+    #
+    def find_files(self, under=None, extension=None, min_size=None):
+        sql = "SELECT f.item_id, f.name, f.size, f.url FROM files f WHERE 1 = 1"
+        params = []
+        if under is not None:
+            sql += " AND f.item_id IN (SELECT item_id FROM ancestors WHERE ancestor_id = ?)"
+            params.append(under)
+        if extension is not None:
+            sql += " AND lower(f.name) LIKE ?"
+            params.append('%' + extension.lower())
+        if min_size is not None:
+            sql += " AND f.size >= ?"
+            params.append(min_size)
+        return self.query(sql + " ORDER BY f.size DESC", params)
+
+    #
+    # Find items whose bounding box intersects the given one
+    #
+    def find_items_in_bbox(self, min_x, min_y, max_x, max_y):
+        return [row[0] for row in self._db.execute(
+            "SELECT id FROM items WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?",
+            (min_x, max_x, min_y, max_y))]
+
+    def _store(self, item):
+        itemid = item['id']
+        bbox = (item.get('spatial') or {}).get('boundingBox') or {}
+        self._db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (itemid, item.get('title'), item.get('parentId'), item_modified(item),
+                          bbox.get('minX'), bbox.get('minY'), bbox.get('maxX'), bbox.get('maxY'),
+                          json.dumps(item)))
+        self._db.execute("DELETE FROM files WHERE item_id = ?", (itemid,))
+        self._db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                             [(itemid, f.get('name'), f.get('size'), f.get('url'), f.get('dateUploaded'))
+                              for f in self._sb.get_item_file_info(item)])
+        self._db.execute("DELETE FROM extents WHERE item_id = ?", (itemid,))
+        self._db.executemany("INSERT INTO extents VALUES (?, ?)",
+                             [(itemid, str(extent.get('id') if isinstance(extent, dict) else extent))
+                              for extent in item.get('extents') or []])
+
+    def _remove(self, itemid):
+        for table, column in (('items', 'id'), ('files', 'item_id'), ('extents', 'item_id')):
+            self._db.execute("DELETE FROM %s WHERE %s = ?" % (table, column), (itemid,))
+
+    #
+    # Recompute the ancestor edges from the parent links of all indexed items
+    #
+    def _rebuild_ancestors(self):
+        self._db.execute("DELETE FROM ancestors")
+        self._db.execute("""
+            INSERT OR IGNORE INTO ancestors (item_id, ancestor_id)
+            WITH RECURSIVE chain (item_id, ancestor_id) AS (
+                SELECT id, parent_id FROM items WHERE parent_id IS NOT NULL
+                UNION
+                SELECT chain.item_id, items.parent_id FROM chain JOIN items ON items.id = chain.ancestor_id
+                WHERE items.parent_id IS NOT NULL
+            )
+            SELECT item_id, ancestor_id FROM chain
+        """)
@@ -0,0 +1,68 @@
+import json
+
+
+#
+# An item's last modification time: provenance.lastUpdated, or dateModified if the server
+# reports no provenance, or None
+#
+def item_modified(item_json):
+    return (item_json.get('provenance') or {}).get('lastUpdated') or item_json.get('dateModified')
+
+
+#
+# ScienceBase item JSON that keeps track of its own changes, for minimal updates.
+#
+# An SbItem is a dict holding the item JSON, plus a snapshot of each top-level field as
+# it was read.  changes() compares the fields with the snapshot, so changes made inside
+# nested lists and dicts (such as appending to item['files']) are seen as well as
+# fields that are set or deleted, and returns only the changed fields, for
+# SbSession.save_item to send.
+#
+# The item's last modification time as read (provenance.lastUpdated, or dateModified) is
+# kept in date_modified, so that save_item can check that nobody else has changed the
+# item in the meantime.
+#
+#     item = sb.get_tracked_item(itemid)
+#     item['title'] = 'New title'
+#     sb.save_item(item)        # sends only {'id': ..., 'title': ...}
+#
+class SbItem(dict):
+    def __init__(self, item_json):
+        dict.__init__(self, item_json)
+        self._take_snapshot()
+
+    #
+    # The names of the top-level fields changed, added or deleted since the item was read
+    # or last saved
+    #
+    def changed_fields(self):
+        names = [name for name, value in self.items()
+                 if name not in self._snapshot or self._snapshot[name] != self._encode(value)]
+        names.extend(name for name in self._snapshot if name not in self)
+        return names
+
+    #
+    # The item ID with the changed fields and their values.  Deleted fields are given as
+    # None, which clears them on ScienceBase.
+    #
+    def changes(self):
+        retval = {'id': self.get('id')}
+        for name in self.changed_fields():
+            retval[name] = self.get(name)
+        return retval
+
+    #
+    # Replace the contents with the item JSON returned by saving the item, and make that
+    # the new baseline for changes
+    #
+    def saved(self, item_json):
+        self.clear()
+        self.update(item_json)
+        self._take_snapshot()
+
+    def _take_snapshot(self):
+        self._snapshot = dict((name, self._encode(value)) for name, value in self.items())
+        self.date_modified = item_modified(self)
+
+    def _encode(self, value):
+        return json.dumps(value, sort_keys=True)
@@ -0,0 +1,166 @@
+import codecs
+import json
+import re
+
+
+#
+# JSON codecs for SbSession and AsyncSbSession.
+#
+# A codec encodes request bodies to UTF-8 bytes and decodes response bodies.  SbJsonCodec
+# uses the standard library and is the default; SbOrjsonCodec uses the optional orjson
+# package, which is several times faster on large search pages.  Sessions take a codec
+# object or one of the names accepted by get_json_codec:
+#
+#     sb = SbSession(json_codec='orjson')
+#
+class SbJsonCodec(object):
+    name = 'json'
+
+    def encode(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class SbOrjsonCodec(object):
+    name = 'orjson'
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError:
+            raise Exception("The orjson JSON codec needs the orjson package (pip install orjson)")
+        self._orjson = orjson
+
+    def encode(self, value):
+        return self._orjson.dumps(value, option=self._orjson.OPT_NON_STR_KEYS)
+
+    def decode(self, data):
+        return self._orjson.loads(data)
+
+
+#
+# Return the codec for codec: None or 'json' for the standard library, 'orjson', 'fast'
+# for orjson if it is installed and the standard library otherwise, or a codec object,
+# which is returned as is
+#
+def get_json_codec(codec=None):
+    if codec is None or codec == 'json':
+        return SbJsonCodec()
+    if codec == 'orjson':
+        return SbOrjsonCodec()
+    if codec == 'fast':
+        try:
+            return SbOrjsonCodec()
+        except Exception:
+            return SbJsonCodec()
+    if isinstance(codec, str):
+        raise Exception("Unknown JSON codec: " + codec)
+    return codec
+
+
+#
+# Incrementally parse a JSON file holding an object, yielding the elements of the array
+# under its top-level key, one at a time, without reading the whole file.  f is any
+# object with a read method returning text or UTF-8 bytes, such as an open file or a
+# streamed HTTP response body.  If others is given, the object's other members are
+# stored in it, once the generator is exhausted.  Otherwise a file that is a single
+# object without that key (such as a lone GeoJSON Feature) yields that object.
+#
+# Elements are decoded with the standard library's decoder, whatever the codec, as it
+# can decode a value from the middle of a buffer.
+#
+def iter_json_array(f, key, chunk_size=64 * 1024, others=None):
+    decoder = json.JSONDecoder()
+    reader = _JsonChunkReader(f, chunk_size)
+
+    def decode():
+        while True:
+            reader.skip_whitespace()
+            try:
+                value, end = decoder.raw_decode(reader.buf, reader.pos)
+                # Strings, objects and arrays end with their closing character, but a number
+                # or literal cut off by the end of the buffer may continue in the next chunk
+                if reader.eof or reader.buf[reader.pos] in '"{[' or \
+                        (end < len(reader.buf) and reader.buf[end] in ' \t\r\n,:]}'):
+                    reader.pos = end
+                    return value
+            except ValueError:
+                if reader.eof:
+                    raise
+            reader.read()
+
+    reader.expect('{')
+    rest = others if others is not None else {}
+    found = False
+    while True:
+        if reader.peek() == '}':
+            break
+        name = decode()
+        reader.expect(':')
+        if name == key:
+            found = True
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield decode()
+                    if reader.peek() == ']':
+                        reader.pos += 1
+                        break
+                    reader.expect(',')
+        else:
+            rest[name] = decode()
+        if reader.peek() == ',':
+            reader.pos += 1
+    if not found and others is None:
+        yield rest
+
+
+_whitespace = re.compile(r'[ \t\r\n]*')
+
+
+#
+# Buffered character reader for iter_json_array.  Consumed text is dropped from the
+# buffer as new chunks are read, and reads grow with the unconsumed text so that a value
+# much larger than chunk_size is not decoded over and over.
+#
+class _JsonChunkReader(object):
+    def __init__(self, f, chunk_size):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        chunk = self._f.read(max(self._chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk, self.eof)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def skip_whitespace(self):
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return
+            self.read()
+
+    def peek(self):
+        self.skip_whitespace()
+        if self.pos >= len(self.buf):
+            raise Exception("Unexpected end of JSON")
+        return self.buf[self.pos]
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise Exception("Invalid JSON: expected '%s' at '%s'" % (c, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
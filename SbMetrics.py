@@ -0,0 +1,155 @@
+import bisect
+import threading
+
+import urllib.parse as urlparse
+
+
+#
+# Per-request instrumentation for SbSession.
+#
+# Every request made by a session with metrics produces one event, a dictionary of:
+#
+#     method       HTTP method
+#     url          request URL
+#     endpoint     endpoint class: item, items, search, upload, download, auth, directory
+#                  or other
+#     status       response status, or None if no response was received
+#     bytes_out    request body size, or None if it was streamed with no known length
+#     bytes_in     response body bytes received
+#     connect      seconds spent opening a connection (0 when one was reused)
+#     ttfb         seconds from sending the request to the response headers, less connect
+#     transfer     seconds spent reading the response body
+#     elapsed      total seconds, including retries and their waits
+#     retries      number of retries made
+#     error        exception message if the request failed without a response
+#
+# The latency split is that of the last attempt.  Responses read with stream=True are
+# recorded when they are closed.
+#
+# Events are passed to each hook, a function taking the event, and aggregated per method
+# and endpoint class into counts, status counts, byte totals and latency histograms,
+# returned by stats().  One SbMetrics object can be shared by several sessions and
+# threads.
+#
+#     metrics = SbMetrics()
+#     metrics.add_hook(lambda event: print(event['method'], event['url'], event['elapsed']))
+#     sb = SbSession(metrics=metrics)
+#     ...
+#     print(sb.stats()['GET item']['elapsed']['p90'])
+#
+class SbMetrics(object):
+    # Upper bounds of the latency histogram buckets, in seconds
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0,
+               float('inf'))
+
+    _latencies = ('connect', 'ttfb', 'transfer', 'elapsed')
+
+    def __init__(self, hooks=None):
+        self._hooks = list(hooks or [])
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    #
+    # Call hook(event) for every request from now on.  Exceptions raised by hooks are
+    # logged and otherwise ignored.
+    #
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    #
+    # Record one request event: add it to the aggregates and pass it to the hooks
+    #
+    def record(self, event):
+        key = '%s %s' % (event['method'], event['endpoint'])
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {'count': 0, 'errors': 0, 'retries': 0, 'bytes_in': 0, 'bytes_out': 0,
+                                            'statuses': {}}
+                for name in self._latencies:
+                    stats[name] = [0] * len(self.buckets) + [0.0, 0.0]
+            stats['count'] += 1
+            stats['retries'] += event['retries']
+            stats['bytes_in'] += event['bytes_in'] or 0
+            stats['bytes_out'] += event['bytes_out'] or 0
+            if event['status'] is None:
+                stats['errors'] += 1
+            else:
+                stats['statuses'][event['status']] = stats['statuses'].get(event['status'], 0) + 1
+            for name in self._latencies:
+                value = event[name]
+                if value is not None:
+                    histogram = stats[name]
+                    histogram[bisect.bisect_left(self.buckets, value)] += 1
+                    histogram[-2] += value
+                    histogram[-1] = max(histogram[-1], value)
+        for hook in list(self._hooks):
+            try:
+                hook(event)
+            except Exception:
+                import logging
+                logging.getLogger(__name__).exception("Request metrics hook failed")
+
+    #
+    # Return the aggregates, keyed by '<method> <endpoint class>'.  Each has count,
+    # errors, retries, bytes_in, bytes_out, statuses (count per status) and, for each of
+    # connect, ttfb, transfer and elapsed, a histogram summary: count, mean, max, the
+    # p50/p90/p99 estimated from the buckets, and buckets, the number of requests in each
+    # bucket: above the previous bucket bound and at or under its own.
+    #
+    def stats(self):
+        with self._lock:
+            retval = {}
+            for key, stats in self._stats.items():
+                summary = dict((name, stats[name]) for name in ('count', 'errors', 'retries', 'bytes_in', 'bytes_out'))
+                summary['statuses'] = dict(stats['statuses'])
+                for name in self._latencies:
+                    summary[name] = self._summarize(stats[name])
+                retval[key] = summary
+            return retval
+
+    #
+    # Clear the aggregates
+    #
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    #
+    # Classify a request by the ScienceBase endpoint it goes to
+    #
+    @staticmethod
+    def endpoint_class(method, url):
+        path = urlparse.urlsplit(url).path
+        if '/josso/' in path:
+            return 'auth'
+        if '/directory/' in path:
+            return 'directory'
+        if '/file/upload' in path:
+            return 'upload'
+        if '/file/' in path:
+            return 'download'
+        if '/catalog/item/' in path:
+            return 'item'
+        if '/catalog/items' in path:
+            return 'search' if method == 'GET' and path.rstrip('/').endswith('/items') else 'items'
+        return 'other'
+
+    def _summarize(self, histogram):
+        counts = histogram[:len(self.buckets)]
+        count = sum(counts)
+        summary = {'count': count, 'mean': histogram[-2] / count if count else None,
+                   'max': histogram[-1] if count else None,
+                   'buckets': dict(zip([str(b) for b in self.buckets], counts))}
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            summary[name] = None
+            seen = 0
+            for bound, n in zip(self.buckets, counts):
+                seen += n
+                if count and seen >= fraction * count:
+                    summary[name] = min(bound, histogram[-1])
+                    break
+        return summary
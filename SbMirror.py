@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import shutil
+
+from SbSession import SbSession
+from SbItem import item_modified
+
+
+#
+# Incremental local mirror of a ScienceBase item tree.
+#
+# The mirror keeps one directory per item under destination, named by item ID, holding
+# item.json and the item's files, plus a manifest (.sbmirror.json) recording for each
+# item its parent, last modification date and the local name, size and upload date of
+# each file (files with the same name get distinct local names, see
+# SbSession.local_file_names).  sync() compares the tree on ScienceBase with the manifest and only fetches what
+# changed: new and modified items are re-read, files are downloaded when they are new or
+# their size or upload date changed, and items and files that are gone from ScienceBase
+# are deleted locally.
+#
+#     mirror = SbMirror(SbSession().login(username, password), root_id, '/data/mirror')
+#     print(mirror.sync())
+#
+# The same is available from the command line:
+#
+#     python SbMirror.py <root_id> <destination> [--username USER] [--env beta]
+#
+class SbMirror(object):
+    _manifest_name = '.sbmirror.json'
+
+    def __init__(self, session, root_id, destination, workers=4, include_shortcuts=False):
+        self._sb = session
+        self._root_id = root_id
+        self._destination = destination
+        self._workers = workers
+        self._include_shortcuts = include_shortcuts
+        self._manifest_path = os.path.join(destination, self._manifest_name)
+
+    #
+    # Bring the mirror up to date.  Returns a summary of the changes made: the number of
+    # items added, updated and deleted, files downloaded and deleted, and bytes
+    # downloaded.  Files that fail to download are listed under 'errors' and retried on
+    # the next sync.
+    #
+    def sync(self):
+        if not os.path.isdir(self._destination):
+            os.makedirs(self._destination)
+        manifest = self._load_manifest()
+        old_items = manifest['items']
+        summary = {'items_added': 0, 'items_updated': 0, 'items_deleted': 0, 'files_downloaded': 0,
+                   'files_deleted': 0, 'bytes_downloaded': 0, 'errors': []}
+
+        # List the tree with just enough of each item to see whether it changed
+        current = {}
+        for item, depth, parentid in self._sb.walk_tree(self._root_id, fields='provenance,dateModified',
+                                                        workers=self._workers,
+                                                        include_shortcuts=self._include_shortcuts):
+            current[item['id']] = {'parentId': parentid, 'modified': item_modified(item)}
+
+        try:
+            for itemid, entry in current.items():
+                old = old_items.get(itemid)
+                if old is not None and old['modified'] == entry['modified'] and entry['modified'] is not None \
+                        and not old.get('incomplete'):
+                    old['parentId'] = entry['parentId']
+                    continue
+                summary['items_updated' if old is not None else 'items_added'] += 1
+                old_items[itemid] = self._sync_item(itemid, entry, old, summary)
+
+            for itemid in [itemid for itemid in old_items if itemid not in current]:
+                shutil.rmtree(self._item_dir(itemid), ignore_errors=True)
+                del old_items[itemid]
+                summary['items_deleted'] += 1
+        finally:
+            self._save_manifest(manifest)
+        return summary
+
+    #
+    # Fetch one new or changed item and its changed files.  Returns its manifest entry.
+    #
+    def _sync_item(self, itemid, entry, old, summary):
+        item_dir = self._item_dir(itemid)
+        if not os.path.isdir(item_dir):
+            os.makedirs(item_dir)
+        item = self._sb.get_item(itemid)
+        with open(os.path.join(item_dir, 'item.json.tmp'), 'w') as f:
+            json.dump(item, f)
+        os.replace(os.path.join(item_dir, 'item.json.tmp'), os.path.join(item_dir, 'item.json'))
+
+        old_files = old['files'] if old else {}
+        old_partial = old.get('partial', {}) if old else {}
+        # Files are kept under their local names, which tell apart files with the same name
+        file_info = [finfo for finfo in self._sb.get_item_file_info(item) if 'name' in finfo and 'url' in finfo]
+        files = {}
+        to_download = []
+        for finfo, local_name in zip(file_info, self._sb.local_file_names(file_info)):
+            meta = {'size': finfo.get('size'), 'dateUploaded': finfo.get('dateUploaded')}
+            files[local_name] = meta
+            if old_files.get(local_name) != meta or not os.path.exists(os.path.join(item_dir, local_name)):
+                to_download.append((finfo, local_name))
+                # Only resume a partial download of the same version of the file
+                if old_partial.get(local_name) != meta:
+                    for suffix in ('.part', '.part.segments'):
+                        if os.path.exists(os.path.join(item_dir, local_name + suffix)):
+                            os.remove(os.path.join(item_dir, local_name + suffix))
+
+        for name in old_files:
+            if name not in files and os.path.exists(os.path.join(item_dir, name)):
+                os.remove(os.path.join(item_dir, name))
+                summary['files_deleted'] += 1
+
+        partial = {}
+        results = self._sb.download_files([finfo for finfo, local_name in to_download], item_dir,
+                                          workers=self._workers, resume=True,
+                                          local_names=[local_name for finfo, local_name in to_download])
+        for result, (finfo, local_name) in zip(results, to_download):
+            if result['error'] is None:
+                summary['files_downloaded'] += 1
+                summary['bytes_downloaded'] += result['bytes']
+            else:
+                partial[local_name] = files.pop(local_name)
+                summary['errors'].append({'id': itemid, 'name': result['name'], 'path': result['path'],
+                                          'error': result['error']})
+
+        retval = {'parentId': entry['parentId'], 'modified': entry['modified'], 'files': files}
+        if partial:
+            # Revisit the item on the next sync to finish its downloads
+            retval['incomplete'] = True
+            retval['partial'] = partial
+        return retval
+
+    def _item_dir(self, itemid):
+        return os.path.join(self._destination, itemid)
+
+    def _load_manifest(self):
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('root') == self._root_id:
+                return manifest
+        return {'root': self._root_id, 'items': {}}
+
+    def _save_manifest(self, manifest):
+        with open(self._manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self._manifest_path + '.tmp', self._manifest_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incrementally mirror a ScienceBase item tree to a local directory')
+    parser.add_argument('root_id', help='ID of the item at the top of the tree to mirror')
+    parser.add_argument('destination', help='local directory for the mirror')
+    parser.add_argument('--username', help='ScienceBase user name; prompts for the password')
+    parser.add_argument('--env', help="'beta', 'dev' or a catalog URL; production by default")
+    parser.add_argument('--workers', type=int, default=4, help='concurrent requests and downloads')
+    parser.add_argument('--include-shortcuts', action='store_true', help='also mirror shortcutted items')
+    args = parser.parse_args()
+
+    sb = SbSession(args.env)
+    if args.username:
+        sb.loginc(args.username)
+    summary = SbMirror(sb, args.root_id, args.destination, args.workers, args.include_shortcuts).sync()
+    print(json.dumps(summary, indent=2))
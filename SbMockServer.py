@@ -0,0 +1,480 @@
+import argparse
+import json
+import random
+import re
+import socket
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import urllib.parse as urlparse
+
+
+#
+# Local stand-in for the ScienceBase catalog, for benchmarks and experiments that should
+# not touch the real service.
+#
+# Implements enough of the catalog for SbSession: item CRUD (catalog/item/), paged
+# search under catalog/items/ with offset/max and nextlink (filters parentId= and
+# ancestors=, and lq=id:(a OR b)), bulk update (PUT catalog/items/),
+# bulk delete (DELETE catalog/items/), file/uploadAndUpsertItem/ and file/upload/
+# multipart uploads, and file/get/<id>?name= downloads and file/get/<id> zips of all of an
+# item's files, both with Range support.  Uploaded file contents are counted and
+# discarded; downloads return generated bytes of each file's recorded size, byte i of a
+# file being i % 256.
+#
+# latency (plus up to jitter more) seconds are added to every response, every
+# throttle_every-th request is answered with 429 and a Retry-After of retry_after
+# seconds, and bandwidth, if given, caps the bytes per second of each download.
+#
+# The server is driven over HTTP, so it can run in another process:
+#
+#     POST /mock/seed     {"parentId": ..., "count": N, "files": F, "file_size": S}
+#                         creates N child items, each with F files of S bytes
+#     POST /mock/config   {"latency": ..., "jitter": ..., "throttle_every": ..., ...}
+#     GET  /mock/stats    request counts
+#     POST /mock/reset    removes every item
+#
+#     server = SbMockServer(latency=0.01)
+#     sb = SbSession(server.start())
+#     ...
+#     server.stop()
+#
+# or from the command line: python SbMockServer.py --port 8080 --latency 0.01
+#
+class SbMockServer(object):
+    _settings = ('latency', 'jitter', 'throttle_every', 'retry_after', 'bandwidth')
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, throttle_every=0, retry_after=0,
+                 bandwidth=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.bandwidth = bandwidth
+        self.items = {}
+        self.counts = {'requests': 0, 'throttled': 0, 'bytes_uploaded': 0, 'bytes_downloaded': 0}
+        self.lock = threading.Lock()
+        self._next_id = 0
+        self._updates = 0
+        self._httpd = _ThreadingHTTPServer((host, port), _MockHandler)
+        self._httpd.mock = self
+        self._thread = None
+
+    #
+    # The catalog URL to pass to SbSession as env
+    #
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://%s:%d/catalog/' % (host, port)
+
+    #
+    # Serve in a background thread and return the catalog URL
+    #
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.url
+
+    #
+    # Serve in the calling thread until interrupted
+    #
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def configure(self, **settings):
+        for name, value in settings.items():
+            if name not in self._settings:
+                raise Exception("Unknown mock server setting: " + name)
+            setattr(self, name, value)
+
+    def new_id(self):
+        with self.lock:
+            self._next_id += 1
+            return '%024x' % self._next_id
+
+    #
+    # Set the item's provenance.lastUpdated, as ScienceBase does when an item is saved
+    #
+    def touch(self, item):
+        with self.lock:
+            self._updates += 1
+            updates = self._updates
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + '.%06dZ' % (updates % 1000000)
+        item['provenance'] = dict(item.get('provenance') or {}, lastUpdated=stamp)
+        return item
+
+    #
+    # Create count items under parentId, each with files files of file_size bytes
+    #
+    def seed(self, parentId=None, count=0, files=0, file_size=0, title='Benchmark item'):
+        if parentId is not None and parentId not in self.items:
+            self.items[parentId] = {'id': parentId, 'title': 'Benchmark parent', 'files': []}
+        ids = []
+        for i in range(count):
+            itemid = self.new_id()
+            item = {'id': itemid, 'title': '%s %d' % (title, i), 'parentId': parentId, 'files': []}
+            for j in range(files):
+                self.add_file(item, 'file%d.bin' % j, file_size)
+            self.items[itemid] = self.touch(item)
+            ids.append(itemid)
+        return ids
+
+    def add_file(self, item, name, size):
+        item.setdefault('files', []).append({
+            'name': name, 'size': size, 'contentType': 'application/octet-stream',
+            'url': '%sfile/get/%s?name=%s' % (self.url, item['id'], urlparse.quote(name)),
+            'dateUploaded': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+
+    #
+    # Items matching the search parameters, in ID order
+    #
+    def search(self, params):
+        items = sorted(self.items.values(), key=lambda item: item['id'])
+        for f in params.get('filter', []):
+            name, _, value = f.partition('=')
+            if name in ('parentId', 'parentIdExcludingLinks'):
+                items = [item for item in items if item.get('parentId') == value]
+            elif name in ('ancestors', 'ancestorsExcludingLinks'):
+                items = [item for item in items if value in self.ancestors(item)]
+        lq = params.get('lq', [None])[0]
+        if lq:
+            match = re.match(r'id:\((.*)\)$', lq)
+            if match:
+                ids = set(match.group(1).split(' OR '))
+                items = [item for item in items if item['id'] in ids]
+        return items
+
+    def ancestors(self, item):
+        retval = []
+        parent = item.get('parentId')
+        while parent is not None and parent not in retval:
+            retval.append(parent)
+            parent = self.items.get(parent, {}).get('parentId')
+        return retval
+
+
+_pattern = bytes(bytearray(range(256))) * 257
+
+
+#
+# n bytes of generated file content from the given offset: byte i of every file is i % 256
+#
+def _file_bytes(offset, n):
+    retval = []
+    while n > 0:
+        start = offset % 256
+        chunk = _pattern[start:start + min(n, 65536)]
+        retval.append(chunk)
+        offset += len(chunk)
+        n -= len(chunk)
+    return b''.join(retval)
+
+
+#
+# A zip archive of the given files with their generated content, stored uncompressed
+#
+def _zip_files(files):
+    import io
+    import zipfile
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        for f in files:
+            zf.writestr(f['name'], _file_bytes(0, f['size']))
+    return buf.getvalue()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Send small responses at once rather than waiting on the client's delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        mock = self.server.mock
+        url = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(url.query)
+        body = self._read_body()
+        if url.path.startswith('/mock/'):
+            return self._control(method, url.path, body)
+
+        with mock.lock:
+            mock.counts['requests'] += 1
+            throttled = mock.throttle_every and mock.counts['requests'] % mock.throttle_every == 0
+            if throttled:
+                mock.counts['throttled'] += 1
+        delay = mock.latency + (random.uniform(0, mock.jitter) if mock.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            return self._send_json({'error': 'Too many requests'}, 429, {'Retry-After': str(mock.retry_after)})
+
+        path = url.path
+        if not path.startswith('/catalog/'):
+            return self._send_json({'error': 'Not found'}, 404)
+        path = path[len('/catalog/'):]
+        if path.startswith('file/get/'):
+            return self._download(method, path[len('file/get/'):], params)
+        if path.startswith('file/upload'):
+            return self._upload(path, body)
+        if path.rstrip('/') == 'items':
+            if method == 'PUT':
+                return self._update_items(json.loads(body.decode('utf-8')))
+            if method == 'DELETE':
+                return self._delete_items(json.loads(body.decode('utf-8')))
+            if method != 'GET':
+                return self._send_json({'error': 'Method not allowed'}, 405)
+            return self._search(params)
+        if path.startswith('item'):
+            return self._item(method, path[len('item'):].strip('/'), params, body)
+        self._send_json({'error': 'Not found'}, 404)
+
+    def _control(self, method, path, body):
+        mock = self.server.mock
+        args = json.loads(body.decode('utf-8')) if body else {}
+        if path == '/mock/seed':
+            return self._send_json({'ids': mock.seed(**args)})
+        if path == '/mock/config':
+            mock.configure(**args)
+            return self._send_json(dict((name, getattr(mock, name)) for name in mock._settings))
+        if path == '/mock/stats':
+            return self._send_json(dict(mock.counts, items=len(mock.items)))
+        if path == '/mock/reset':
+            mock.items.clear()
+            return self._send_json({})
+        self._send_json({'error': 'Not found'}, 404)
+
+    def _item(self, method, itemid, params, body):
+        mock = self.server.mock
+        if method == 'POST' and not itemid:
+            item = json.loads(body.decode('utf-8'))
+            item['id'] = mock.new_id()
+            mock.items[item['id']] = mock.touch(item)
+            return self._send_json(item)
+        item = mock.items.get(itemid)
+        if item is None:
+            return self._send_json({'error': 'Item not found'}, 404)
+        if method == 'PUT':
+            item.update(json.loads(body.decode('utf-8')))
+            mock.touch(item)
+        elif method == 'DELETE':
+            del mock.items[itemid]
+            return self._send_json({})
+        self._send_json(self._fields(item, params))
+
+    def _update_items(self, items):
+        mock = self.server.mock
+        retval = []
+        for item in items:
+            if item.get('id') not in mock.items:
+                return self._send_json({'error': 'Item not found: %s' % item.get('id')}, 404)
+            mock.items[item['id']].update(item)
+            mock.touch(mock.items[item['id']])
+            retval.append(mock.items[item['id']])
+        self._send_json(retval)
+
+    def _delete_items(self, items):
+        mock = self.server.mock
+        for item in items:
+            mock.items.pop(item.get('id'), None)
+        self._send_json({})
+
+    def _search(self, params):
+        mock = self.server.mock
+        items = mock.search(params)
+        offset = int(params.get('offset', ['0'])[0])
+        count = int(params.get('max', ['20'])[0])
+        page = {'total': len(items), 'items': [self._fields(item, params) for item in items[offset:offset + count]]}
+        if offset + count < len(items):
+            query = dict((name, values) for name, values in params.items() if name != 'offset')
+            query['offset'] = [str(offset + count)]
+            page['nextlink'] = {'url': '%sitems?%s' % (mock.url, urlparse.urlencode(query, doseq=True))}
+        self._send_json(page)
+
+    def _fields(self, item, params):
+        fields = params.get('fields')
+        if not fields:
+            return item
+        names = fields[0].split(',')
+        return dict((name, value) for name, value in item.items() if name == 'id' or name in names)
+
+    def _upload(self, path, body):
+        mock = self.server.mock
+        fields, files = _parse_multipart(self.headers.get('Content-Type', ''), body)
+        with mock.lock:
+            mock.counts['bytes_uploaded'] += sum(size for name, filename, size in files)
+        if path.startswith('file/upload/'):
+            return self._send_json([{'fileKey': mock.new_id(), 'name': filename, 'size': size,
+                                     'dateUploaded': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                                     'uploadedBy': 'benchmark'} for name, filename, size in files])
+        item = json.loads(fields.get('item', '{}'))
+        itemid = fields.get('id') or item.get('id')
+        if itemid and itemid in mock.items:
+            stored = mock.items[itemid]
+            stored.update(dict((k, v) for k, v in item.items() if k != 'files'))
+        else:
+            stored = dict(item, id=itemid or mock.new_id(), files=[])
+            mock.items[stored['id']] = stored
+        for name, filename, size in files:
+            mock.add_file(stored, filename or 'file', size)
+        self._send_json(mock.touch(stored))
+
+    def _download(self, method, itemid, params):
+        mock = self.server.mock
+        item = mock.items.get(itemid)
+        if item is None:
+            return self._send_json({'error': 'Item not found'}, 404)
+        name = params.get('name', [None])[0]
+        if name is None:
+            # All of the item's files as one zip
+            content = _zip_files(item.get('files', []))
+            return self._send_range(method, len(content), lambda offset, n: content[offset:offset + n],
+                                    {'Content-Type': 'application/zip',
+                                     'Content-Disposition': 'attachment; filename=%s.zip' % itemid})
+        entry = next((f for f in item.get('files', []) if f['name'] == name), None)
+        if entry is None:
+            return self._send_json({'error': 'File not found'}, 404)
+        self._send_range(method, entry['size'], _file_bytes,
+                         {'Content-Type': 'application/octet-stream',
+                          'Content-Disposition': 'attachment; filename=%s' % name})
+
+    #
+    # Send size bytes, read(offset, n) at a time, or the part asked for by a Range header
+    #
+    def _send_range(self, method, size, read, headers):
+        mock = self.server.mock
+        start, end = 0, size - 1
+        status = 200
+        headers = dict(headers, **{'Accept-Ranges': 'bytes'})
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                headers['Content-Range'] = 'bytes */%d' % size
+                return self._send(416, b'', headers)
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        length = max(end - start + 1, 0)
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        if method == 'HEAD':
+            return
+        sent = 0
+        began = time.time()
+        while sent < length:
+            chunk = read(start + sent, min(65536, length - sent))
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if mock.bandwidth:
+                ahead = sent / float(mock.bandwidth) - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+        with mock.lock:
+            mock.counts['bytes_downloaded'] += sent
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline().strip():
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send_json(self, value, status=200, headers=None):
+        self._send(status, json.dumps(value).encode('utf-8'), dict(headers or {}, **{'Content-Type': 'application/json'}))
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+#
+# Split a multipart/form-data body into its fields ({name: value}) and files
+# ([(name, filename, size)])
+#
+def _parse_multipart(content_type, body):
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    fields = {}
+    files = []
+    if not match:
+        return fields, files
+    delimiter = b'--' + match.group(1).encode('latin-1')
+    for part in body.split(delimiter)[1:]:
+        if part.startswith(b'--'):
+            break
+        head, _, data = part.partition(b'\r\n\r\n')
+        data = data[:-2] if data.endswith(b'\r\n') else data
+        disposition = head.decode('utf-8', 'replace')
+        name = re.search(r'name="([^"]*)"', disposition)
+        filename = re.search(r'filename="([^"]*)"', disposition)
+        if filename:
+            files.append((name.group(1) if name else None, filename.group(1), len(data)))
+        elif name:
+            fields[name.group(1)] = data.decode('utf-8')
+    return fields, files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the ScienceBase catalog')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds, at random')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth request with 429')
+    parser.add_argument('--retry-after', type=float, default=0, help='Retry-After of throttled responses')
+    parser.add_argument('--bandwidth', type=int, help='bytes per second of each download')
+    args = parser.parse_args()
+
+    server = SbMockServer(args.host, args.port, args.latency, args.jitter, args.throttle_every, args.retry_after,
+                          args.bandwidth)
+    print('Serving the ScienceBase stand-in at ' + server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
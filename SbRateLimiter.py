@@ -0,0 +1,165 @@
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; limiters there can only be shared between threads
+    fcntl = None
+
+
+#
+# Client-side token bucket rate limiter for ScienceBase requests.
+#
+# rate is the sustained number of requests per second and burst the number that may be
+# sent at once after a quiet period (defaults to rate).  byte_rate and byte_burst do the
+# same for bytes sent and received.  Either limit may be None for no limit.
+#
+# One limiter object can be shared by any number of sessions and threads.  To share a
+# limit between processes on the same machine, give every process a limiter with the
+# same path: the bucket state is then kept in that file, updated under an exclusive
+# file lock, so all the processes together stay within the configured rates.
+#
+#     limiter = SbRateLimiter(rate=10, byte_rate=50 * 1024 * 1024, path='/tmp/sciencebase.bucket')
+#     sb = SbSession(rate_limiter=limiter)
+#
+class SbRateLimiter(object):
+    _state_format = '<ddd'
+
+    def __init__(self, rate=None, burst=None, byte_rate=None, byte_burst=None, path=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else (max(rate, 1) if rate else None)
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst if byte_burst is not None else byte_rate
+        self.path = path
+        if path is not None and fcntl is None:
+            raise Exception("Sharing a rate limiter between processes needs fcntl file locking")
+        self._lock = threading.Lock()
+        self._state = (self.burst or 0.0, self.byte_burst or 0.0, time.time())
+        self._waits = 0
+        self._wait_time = 0.0
+
+    #
+    # Block until a request sending nbytes bytes may go ahead.  Returns the number of
+    # seconds spent waiting.  count=0 waits for the bytes only, for metering the body of
+    # a request already under way as it is sent or received.
+    #
+    def acquire(self, nbytes=0, count=1):
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(nbytes, count)
+            if wait == 0:
+                if waited:
+                    with self._lock:
+                        self._waits += 1
+                        self._wait_time += waited
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    #
+    # Take the tokens for a request sending nbytes bytes if they are available and return
+    # 0, or return the number of seconds to wait before trying again.  For callers that
+    # do their own waiting, such as asyncio code.
+    #
+    def try_acquire(self, nbytes=0, count=1):
+        with self._locked_state() as state:
+            requests, nbytes_available, now = state
+            wait = 0.0
+            if self.rate and count and requests < 1:
+                wait = (1 - requests) / float(self.rate)
+            if self.byte_rate and nbytes:
+                # Requests larger than the burst go ahead once the bucket is full, and
+                # leave it in debt for the following ones
+                needed = min(nbytes, self.byte_burst)
+                if nbytes_available < needed:
+                    wait = max(wait, (needed - nbytes_available) / float(self.byte_rate))
+            if wait == 0:
+                if self.rate:
+                    state[0] = requests - count
+                if self.byte_rate:
+                    state[1] = nbytes_available - nbytes
+            return wait
+
+    #
+    # Charge nbytes bytes received, such as a response body, to the byte bucket without
+    # waiting.  Later requests wait for the debt to be repaid.
+    #
+    def consume(self, nbytes):
+        if self.byte_rate and nbytes:
+            with self._locked_state() as state:
+                state[1] -= nbytes
+
+    #
+    # Return the number of requests that had to wait, and the total seconds waited
+    #
+    def stats(self):
+        with self._lock:
+            return {'waits': self._waits, 'wait_time': self._wait_time}
+
+    #
+    # Context manager giving the refilled bucket state as a mutable [requests, bytes, time]
+    # list, under the thread lock and, for shared limiters, the file lock.  Changes are
+    # saved on exit.
+    #
+    def _locked_state(self):
+        return _LockedState(self)
+
+    def _refill(self, state):
+        requests, nbytes, last = state
+        now = time.time()
+        elapsed = max(now - last, 0.0)
+        if self.rate:
+            requests = min(self.burst, requests + elapsed * self.rate)
+        if self.byte_rate:
+            nbytes = min(self.byte_burst, nbytes + elapsed * self.byte_rate)
+        return [requests, nbytes, now]
+
+
+#
+# See SbRateLimiter._locked_state
+#
+class _LockedState(object):
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._file = None
+        self._state = None
+
+    def __enter__(self):
+        limiter = self._limiter
+        limiter._lock.acquire()
+        try:
+            state = limiter._state
+            if limiter.path is not None:
+                self._file = os.fdopen(os.open(limiter.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+                self._file.seek(0)
+                data = self._file.read(struct.calcsize(limiter._state_format))
+                if len(data) == struct.calcsize(limiter._state_format):
+                    state = struct.unpack(limiter._state_format, data)
+            self._state = limiter._refill(state)
+            return self._state
+        except Exception:
+            self._release()
+            raise
+
+    def __exit__(self, exc_type, exc, tb):
+        limiter = self._limiter
+        try:
+            limiter._state = tuple(self._state)
+            if self._file is not None:
+                self._file.seek(0)
+                self._file.write(struct.pack(limiter._state_format, *self._state))
+                self._file.flush()
+        finally:
+            self._release()
+        return False
+
+    def _release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._limiter._lock.release()
@@ -0,0 +1,98 @@
+import random
+import threading
+import time
+
+
+#
+# Retry policy shared by SbSession and AsyncSbSession.
+#
+# A request is retried when it fails to connect or time out, or when the response status
+# is in retry_statuses (by default the rate limiter's 429 and the gateway/WAF 502, 503
+# and 504), but only for the HTTP methods in retry_methods, which defaults to the
+# idempotent ones.  Retries wait with jittered exponential backoff, backoff * 2**attempt
+# seconds capped at max_backoff, or for as long as the server's Retry-After header asks
+# (up to max_retry_after).  At most max_retries retries are made for one request.
+#
+# Retries also draw on a budget shared by every request made with the policy: at any
+# time at most min_budget + budget_ratio * requests retries may have been made, so a
+# server that is down does not multiply the load put on it.
+#
+# The policy only computes delays and keeps counters; the sessions do the waiting, so
+# the same policy works for blocking and asyncio clients.  It is safe to share between
+# threads.
+#
+class SbRetryPolicy(object):
+    def __init__(self, max_retries=5, backoff=0.5, max_backoff=60.0, max_retry_after=300.0,
+                 retry_statuses=(429, 502, 503, 504),
+                 retry_methods=('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'),
+                 budget_ratio=0.2, min_budget=10):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = set(retry_statuses)
+        self.retry_methods = set(m.upper() for m in retry_methods)
+        self.budget_ratio = budget_ratio
+        self.min_budget = min_budget
+        self._lock = threading.Lock()
+        self._counters = {'requests': 0, 'retried': 0, 'throttled': 0, 'errors': 0, 'budget_exhausted': 0}
+
+    #
+    # Record the outcome of one attempt at a request: its response status, or error=True
+    # if no response was received
+    #
+    def record(self, status=None, error=False):
+        with self._lock:
+            self._counters['requests'] += 1
+            if error:
+                self._counters['errors'] += 1
+            elif status in (429, 503):
+                self._counters['throttled'] += 1
+
+    #
+    # Decide whether to retry a request after the given attempt (counting from 0).  Pass
+    # the response status and Retry-After header, or error=True if no response was
+    # received.  method=None skips the retry_methods check, for callers that know the
+    # operation is safe to repeat.  Returns the number of seconds to wait before
+    # retrying, or None if the request should not be retried.
+    #
+    def next_delay(self, method, attempt, status=None, retry_after=None, error=False):
+        if not error and status not in self.retry_statuses:
+            return None
+        if (method is not None and method.upper() not in self.retry_methods) or attempt >= self.max_retries:
+            return None
+        with self._lock:
+            if self._counters['retried'] >= self.min_budget + self.budget_ratio * self._counters['requests']:
+                self._counters['budget_exhausted'] += 1
+                return None
+            self._counters['retried'] += 1
+
+        delay = self._parse_retry_after(retry_after)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return delay
+
+    #
+    # Return a copy of the counters: requests (attempts made), retried, throttled (429
+    # and 503 responses), errors (connection failures and timeouts) and
+    # budget_exhausted (retries refused by the retry budget)
+    #
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    #
+    # Convert a Retry-After header, in seconds or as an HTTP date, into seconds to wait
+    #
+    def _parse_retry_after(self, retry_after):
+        if not retry_after:
+            return None
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            from email.utils import parsedate_tz, mktime_tz
+            parsed = parsedate_tz(retry_after)
+            if parsed is None:
+                return None
+            delay = mktime_tz(parsed) - time.time()
+        return min(max(delay, 0.0), self.max_retry_after)
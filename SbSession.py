@@ -1,35 +1,31 @@
 # requests is an optional library that can be found at http://docs.python-requests.org/en/latest/
-from __future__ import print_function
-try:
-    # For Python 3.0 and later
-    import http.client as httplib
-    from urllib.request import urlopen
-    from urllib.parse import urlencode
-    import urllib.parse as urlparse
-
-except ImportError:
-    # Fall back to Python 2's urllib2
-    import httplib
-    from urllib import urlencode
-    from urllib2 import urlopen
-    import urlparse
+from urllib.parse import urlencode
+import urllib.parse as urlparse
+import queue
 
-
-import requests
+# requests, mimetypes, getpass and the other modules only some calls need are imported
+# where they are used, to keep importing this module and creating sessions fast
 import json
 import os
-import getpass
-import logging
-import mimetypes
-from pkg_resources import get_distribution
-from pkg_resources import DistributionNotFound
+import threading
+import time
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # T.Wellman add
 from io import BytesIO
 from re import findall, compile, IGNORECASE
 from contextlib import closing
+from functools import partial
+from collections import OrderedDict
+
+from SbRetryPolicy import SbRetryPolicy
+from SbMetrics import SbMetrics
+from SbJson import get_json_codec, iter_json_array
+from SbItem import SbItem, item_modified
 
-class SbSession:
+class SbSession(object):
     _josso_url = None
     _base_sb_url = None
     _base_item_url = None
@@ -46,14 +42,42 @@ class SbSession:
     _users_id = None
     _username = None
     _jossosessionid = None
-    _session = None
-    _retry = False
+    _requests_session = None
+    _item_cache = None
+    _retry_policy = None
+    _rate_limiter = None
+    _metrics = None
+    _json = None
+    _upload_dedup = None
     _max_item_count = 1000
+    # Longest lq id:(...) query get_items puts in one URL, encoded, to stay under the URI
+    # limits of servers and proxies on the way
+    _max_id_query_length = 6000
 
     #
     # Initialize session and set JSON headers
     #
-    def __init__(self, env=None):
+    # Requests that fail with a connection error or a 429/502/503/504 response are
+    # retried according to retry_policy, an SbRetryPolicy (the defaults when None).
+    # Pass SbRetryPolicy(max_retries=0) to turn retries off.
+    #
+    # rate_limiter, an SbRateLimiter, is consulted before every request, including
+    # retries, to keep this session (and any others sharing the limiter) within its
+    # request and byte rates.
+    #
+    # pool_size is the number of connections kept open per host, which should be at least
+    # the number of threads using the session at once.  timeout is the default connect
+    # and read timeout in seconds for every request (None waits forever), and
+    # keep_alive=False closes each connection after its request.
+    #
+    # Every request is recorded in metrics, an SbMetrics (a new one when None), which
+    # aggregates them for stats() and passes each request's event to its hooks.
+    #
+    # json_codec encodes request bodies and decodes responses: a codec object or a name
+    # for SbJson.get_json_codec, such as 'orjson'.  The standard library's by default.
+    #
+    def __init__(self, env=None, retry_policy=None, rate_limiter=None, pool_size=10, timeout=None, keep_alive=True,
+                 metrics=None, json_codec=None):
         if env == 'beta':
             self._base_sb_url = "https://beta.sciencebase.gov/catalog/"
             self._base_directory_url = "https://beta.sciencebase.gov/directory/"
@@ -63,6 +87,13 @@ class SbSession:
             self._base_sb_url = "http://localhost:8090/catalog/"
             self._base_directory_url = "https://beta.sciencebase.gov/directory/"
             self._josso_url = "https://my-beta.usgs.gov/josso/signon/usernamePasswordLogin.do"
+        elif env and env.startswith('http'):
+            # A catalog URL, such as a local stand-in server for testing.  Directory and
+            # JOSSO requests go to the same host.
+            o = urlparse.urlsplit(env)
+            self._base_sb_url = env if env.endswith('/') else env + '/'
+            self._base_directory_url = "%s://%s/directory/" % (o.scheme, o.netloc)
+            self._josso_url = "%s://%s/josso/signon/usernamePasswordLogin.do" % (o.scheme, o.netloc)
         else:
             self._base_sb_url = "https://www.sciencebase.gov/catalog/"
             self._base_directory_url = "https://www.sciencebase.gov/directory/"
@@ -80,14 +111,63 @@ class SbSession:
         self._base_unlink_item_url = self._base_items_url + "unlink/"
         self._base_person_url = self._base_directory_url + "person/"
 
-        self._session = requests.Session()
-        self._session.headers.update({'Accept': 'application/json'})
+        self._retry_policy = retry_policy if retry_policy is not None else SbRetryPolicy()
+        self._rate_limiter = rate_limiter
+        self._metrics = metrics if metrics is not None else SbMetrics()
+        self._json = get_json_codec(json_codec)
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._keep_alive = keep_alive
+
+    #
+    # The underlying requests session, created on first use
+    #
+    @property
+    def _session(self):
+        if self._requests_session is None:
+            with _session_lock:
+                if self._requests_session is None:
+                    self._requests_session = self._new_requests_session()
+        return self._requests_session
+
+    @_session.setter
+    def _session(self, session):
+        self._requests_session = session
+
+    #
+    # Create the underlying requests session, with connection pools sized to pool_size
+    #
+    def _new_requests_session(self):
+        from SbHttp import _SbRequestsSession, _SbHTTPAdapter
+        session = _SbRequestsSession(self._retry_policy, self._rate_limiter, self._timeout, self._metrics)
+        adapter = _SbHTTPAdapter(pool_connections=self._pool_size, pool_maxsize=self._pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Accept': 'application/json'})
+        if not self._keep_alive:
+            session.headers.update({'Connection': 'close'})
         pysb_agent = ' sciencebase-pysb'
-        try:
-            pysb_agent += '/%s' % get_distribution("pysb").version
-        except DistributionNotFound:
-            pass
-        self._session.headers.update({'User-Agent': self._session.headers['User-Agent'] + pysb_agent})
+        if _pysb_version():
+            pysb_agent += '/%s' % _pysb_version()
+        session.headers.update({'User-Agent': session.headers['User-Agent'] + pysb_agent})
+        return session
+
+    #
+    # Return a new SbSession with its own connections that shares this session's login,
+    # settings, retry policy, rate limiter and item cache.  Useful to give each worker
+    # thread a session of its own; see SbSessionPool.
+    #
+    def clone(self):
+        other = SbSession.__new__(SbSession)
+        other.__dict__.update(self.__dict__)
+        if self._requests_session is None:
+            # Nothing to share yet; the clone creates its own session when first used
+            return other
+        other._session = self._new_requests_session()
+        other._session.cookies.update(self._session.cookies)
+        other._session.params = dict(self._session.params)
+        other._session.headers.update(self._session.headers)
+        return other
 
     #
     # Log into ScienceBase
@@ -118,6 +198,7 @@ class SbSession:
     # Log into ScienceBase, prompting for the password
     #
     def loginc(self, username):
+        import getpass
         tries = 0
         while (tries < 5):
             password = getpass.getpass()
@@ -153,38 +234,249 @@ class SbSession:
     #
     # Returns JSON for the ScienceBase Item with the given ID
     #
+    # When the item cache is enabled (see enable_item_cache) fresh cached copies are
+    # returned without a request, and stale ones are revalidated with ETag/Last-Modified.
+    #
     def get_item(self, itemid, params=None):
         url = self._base_item_url + itemid
+        if self._item_cache is not None:
+            return self._get_cached_item(itemid, params)
         # if (isinstance(params, dict)):
         ret = self._session.get(self._base_item_url + itemid, params=params)
         return self._get_json(ret)
 
+    #
+    # get_item through the item cache
+    #
+    def _get_cached_item(self, itemid, params):
+        cache = self._item_cache
+        key = (itemid, tuple(sorted((params or {}).items())))
+        entry, fresh = cache.get(key)
+        if fresh:
+            return self._json.decode(entry['content'])
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        ret = self._session.get(self._base_item_url + itemid, params=params, headers=headers)
+        if entry is not None and ret.status_code == 304:
+            cache.revalidated(key)
+            return self._json.decode(entry['content'])
+        item = self._get_json(ret)
+        cache.put(key, ret.content, ret.headers.get('ETag'), ret.headers.get('Last-Modified'))
+        return item
+
+    #
+    # Turn on caching of get_item results.  The cache holds at most max_items items and,
+    # if given, max_bytes bytes of item JSON, evicting the least recently used.  Cached
+    # items are returned without a request for ttl seconds, after which they are
+    # revalidated with the server where it supports ETag or Last-Modified.  Items are
+    # dropped from the cache when this session updates, moves, deletes or uploads to them.
+    #
+    def enable_item_cache(self, max_items=1000, max_bytes=None, ttl=300):
+        self._item_cache = SbItemCache(max_items, max_bytes, ttl)
+        return self
+
+    #
+    # Turn off item caching and discard the cache
+    #
+    def disable_item_cache(self):
+        self._item_cache = None
+
+    #
+    # Return the item cache counters: hits, misses, revalidated, evictions, items and bytes
+    #
+    def item_cache_stats(self):
+        return self._item_cache.stats() if self._item_cache is not None else None
+
+    #
+    # Drop the given item IDs from the item cache
+    #
+    def _invalidate_items(self, itemids):
+        if self._item_cache is not None:
+            for itemid in itemids:
+                if itemid:
+                    self._item_cache.invalidate(itemid)
+
+    #
+    # Get many ScienceBase Items in a few search requests rather than one get_item call each.
+    #
+    # The IDs are split into chunks of up to _max_item_count, and short enough for the
+    # query to fit in a URL, each resolved with one paged find_items query, and chunks
+    # are fetched by up to workers threads.  fields
+    # is a comma separated string or list of the fields to return, such as
+    # 'title,files'; without it the server returns its default search fields.
+    #
+    # Returns (items, missing): the items found, in the order of ids, and the IDs that
+    # were not found or are not visible to the user.
+    #
+    def get_items(self, ids, fields=None, workers=4):
+        if fields is not None and not isinstance(fields, str):
+            fields = ','.join(fields)
+        unique_ids = list(OrderedDict.fromkeys(ids))
+        chunks = []
+        length = 0
+        for itemid in unique_ids:
+            # ' OR ' and the ID, as encoded in the query string
+            id_length = len(urlencode({'': ' OR ' + itemid})) - 1
+            if not chunks or len(chunks[-1]) >= self._max_item_count or length + id_length > self._max_id_query_length:
+                chunks.append([])
+                length = 0
+            chunks[-1].append(itemid)
+            length += id_length
+
+        def fetch(chunk):
+            params = {'q': '', 'lq': 'id:(' + ' OR '.join(chunk) + ')', 'max': len(chunk)}
+            if fields:
+                params['fields'] = fields
+            return list(self.iter_items(params, prefetch=0))
+
+        found = {}
+        if workers <= 1 or len(chunks) <= 1:
+            results = [fetch(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+                results = list(pool.map(fetch, chunks))
+        for items in results:
+            for item in items:
+                found[item['id']] = item
+        items = [found[itemid] for itemid in ids if itemid in found]
+        missing = [itemid for itemid in unique_ids if itemid not in found]
+        return items, missing
+
     #
     # Create a new Item in ScienceBase
     #
     def create_item(self, item_json):
-        ret = self._session.post(self._base_item_url, data=json.dumps(item_json))
+        ret = self._session.post(self._base_item_url, data=self._json.encode(item_json))
         return self._get_json(ret)
 
     #
     # Update an existing ScienceBase Item
     #
     def update_item(self, item_json):
-        ret = self._session.put(self._base_item_url + item_json['id'], data=json.dumps(item_json))
+        ret = self._session.put(self._base_item_url + item_json['id'], data=self._json.encode(item_json))
+        self._invalidate_items([item_json['id']])
         return self._get_json(ret)
 
+    #
+    # Get the ScienceBase Item JSON with the given ID as an SbItem, which records changes
+    # made to it so that save_item sends only those.  params are as for get_item; with a
+    # 'fields' param only the fields fetched can be tracked.
+    #
+    def get_tracked_item(self, itemid, params=None):
+        return SbItem(self.get_item(itemid, params))
+
+    #
+    # Save the changes made to an SbItem, sending only the changed top-level fields
+    # rather than the whole item.  Nothing is sent if there are no changes.
+    #
+    # With check_modified (the default), the item's modification time is first read from
+    # ScienceBase, and if the item was changed since it was fetched an exception is
+    # raised and nothing is saved, rather than overwriting the other change.  The check
+    # and the update are separate requests, so a change made between them is not seen.
+    #
+    # Returns the item, updated with the JSON returned by ScienceBase.
+    #
+    def save_item(self, item, check_modified=True):
+        changes = item.changes()
+        if len(changes) == 1:
+            return item
+        if check_modified and item.date_modified is not None:
+            ret = self._session.get(self._base_item_url + item['id'], params={'fields': 'provenance,dateModified'})
+            modified = item_modified(self._get_json(ret))
+            if modified != item.date_modified:
+                raise Exception("Item " + item['id'] + " was modified at " + str(modified) +
+                                " after it was read (" + str(item.date_modified) + ")")
+        item.saved(self.update_item(changes))
+        return item
+
     #
     # Update multiple ScienceBase items (takes an array of items)
     #
     def update_items(self, items_json):
-        ret = self._session.put(self._base_items_url, data=json.dumps(items_json))
+        ret = self._session.put(self._base_items_url, data=self._json.encode(items_json))
+        self._invalidate_items([item_json.get('id') for item_json in items_json])
         return self._get_json(ret)
 
+    #
+    # Update many ScienceBase items through a pipeline of update_items requests.
+    #
+    # Items are grouped into chunks of at most max_count items (default _max_item_count)
+    # and max_bytes bytes of JSON, and the chunks are sent by up to workers threads.
+    # rate, if given, caps the number of requests started per second.  When a chunk
+    # fails its items are retried one at a time with update_item, so a single bad item
+    # only fails itself.
+    #
+    # Returns a dict with 'updated', the updated item JSON in input order, 'failed', a
+    # list of {'id', 'error'} entries, and 'requests', the number of requests sent.
+    #
+    def bulk_update_items(self, items_json, max_count=None, max_bytes=5 * 1024 * 1024, workers=4, rate=None):
+        max_count = max_count or self._max_item_count
+        chunks = []
+        chunk, chunk_bytes = [], 2
+        for item_json in items_json:
+            encoded = self._json.encode(item_json)
+            if chunk and (len(chunk) >= max_count or chunk_bytes + len(encoded) + 1 > max_bytes):
+                chunks.append(chunk)
+                chunk, chunk_bytes = [], 2
+            chunk.append((item_json, encoded))
+            chunk_bytes += len(encoded) + 1
+        if chunk:
+            chunks.append(chunk)
+
+        pace_lock = threading.Lock()
+        next_start = [time.time()]
+        request_count = [0]
+
+        def paced(func, *args):
+            with pace_lock:
+                request_count[0] += 1
+                if rate:
+                    delay = next_start[0] - time.time()
+                    next_start[0] = max(next_start[0], time.time()) + 1.0 / rate
+                    if delay > 0:
+                        time.sleep(delay)
+            return func(*args)
+
+        def put_chunk(chunk):
+            body = b'[' + b','.join(encoded for item_json, encoded in chunk) + b']'
+            try:
+                ret = paced(self._session.put, self._base_items_url, body)
+                self._invalidate_items([item_json.get('id') for item_json, encoded in chunk])
+                return [(item_json.get('id'), updated, None) for (item_json, encoded), updated
+                        in zip(chunk, self._get_json(ret))]
+            except Exception:
+                results = []
+                for item_json, encoded in chunk:
+                    try:
+                        results.append((item_json.get('id'), paced(self.update_item, item_json), None))
+                    except Exception as e:
+                        results.append((item_json.get('id'), None, str(e)))
+                return results
+
+        if workers <= 1 or len(chunks) <= 1:
+            chunk_results = [put_chunk(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+                chunk_results = list(pool.map(put_chunk, chunks))
+        retval = {'updated': [], 'failed': [], 'requests': request_count[0]}
+        for results in chunk_results:
+            for itemid, updated, error in results:
+                if error is None:
+                    retval['updated'].append(updated)
+                else:
+                    retval['failed'].append({'id': itemid, 'error': error})
+        return retval
+
     #
     # Delete an existing ScienceBase Item
     #
     def delete_item(self, item_json):
-        ret = self._session.delete(self._base_item_url + item_json['id'], data=json.dumps(item_json))
+        ret = self._session.delete(self._base_item_url + item_json['id'], data=self._json.encode(item_json))
+        self._invalidate_items([item_json['id']])
         self._check_errors(ret)
         return True
 
@@ -193,6 +485,7 @@ class SbSession:
     #
     def undelete_item(self, itemid):
         ret = self._session.post(self._base_undelete_item_url, params={'itemId': itemid})
+        self._invalidate_items([itemid])
         self._check_errors(ret)
         return self._get_json(ret)
 
@@ -207,7 +500,8 @@ class SbSession:
             ids_json = []
             for itemId in itemIds[i:i + self._max_item_count]:
                 ids_json.append({'id': itemId})
-            ret = self._session.delete(self._base_items_url, data=json.dumps(ids_json))
+            ret = self._session.delete(self._base_items_url, data=self._json.encode(ids_json))
+            self._invalidate_items(itemIds[i:i + self._max_item_count])
             self._check_errors(ret)
         return True
 
@@ -216,20 +510,81 @@ class SbSession:
     #
     def move_item(self, itemid, parentid):
         ret = self._session.post(self._base_move_item_url, params={'itemId': itemid, 'destId': parentid})
+        self._invalidate_items([itemid])
         self._check_errors(ret)
         return self._get_json(ret)
 
     #
-    # Move ScienceBase Items under a new parent
+    # Move ScienceBase Items under a new parent.  Returns the number of items moved.
     #
     def move_items(self, itemids, parentid):
-        count = 0
-        if itemids:
-            for itemid in itemids:
-                print('moving ' + itemid)
-                self.move_item(itemid, parentid)
-                count += 1
-        return count
+        report = self.bulk_move_items(itemids or [], parentid)
+        failed = [r for r in report if not r['ok']]
+        if failed:
+            raise Exception("Failed to move %d of %d items, first error: %s: %s" %
+                            (len(failed), len(report), failed[0]['id'], failed[0]['error']))
+        return len(report)
+
+    #
+    # Move many ScienceBase Items under a new parent.
+    #
+    # By default each item is moved with its own move request, with up to workers
+    # requests in flight.  With batch=True the items are instead moved by rewriting
+    # their parentId through update_items, _max_item_count items per request.
+    #
+    # Returns a report with one {'id', 'ok', 'error'} entry per item, in order.
+    #
+    def bulk_move_items(self, itemids, parentid, workers=8, batch=False):
+        if not batch:
+            return self._run_per_item(lambda itemid: self.move_item(itemid, parentid), itemids, workers)
+
+        def move_chunk(chunk):
+            try:
+                updated = self.update_items([{'id': itemid, 'parentId': parentid} for itemid in chunk])
+            except Exception as e:
+                return [{'id': itemid, 'ok': False, 'error': str(e)} for itemid in chunk]
+            moved = set(item['id'] for item in updated if item.get('parentId') == parentid)
+            return [{'id': itemid, 'ok': itemid in moved,
+                     'error': None if itemid in moved else 'parentId not updated'} for itemid in chunk]
+
+        chunks = [itemids[i:i + self._max_item_count] for i in range(0, len(itemids), self._max_item_count)]
+        if workers <= 1 or len(chunks) <= 1:
+            results = [move_chunk(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+                results = list(pool.map(move_chunk, chunks))
+        return [r for chunk_report in results for r in chunk_report]
+
+    #
+    # Create shortcuts to many items under the given parent, with up to workers requests
+    # in flight.  Returns a report with one {'id', 'ok', 'error'} entry per item, in order.
+    #
+    def bulk_create_shortcuts(self, itemids, parentid, workers=8):
+        return self._run_per_item(lambda itemid: self.create_shortcut(itemid, parentid), itemids, workers)
+
+    #
+    # Remove the shortcuts to many items from the given parent, with up to workers requests
+    # in flight.  Returns a report with one {'id', 'ok', 'error'} entry per item, in order.
+    #
+    def bulk_remove_shortcuts(self, itemids, parentid, workers=8):
+        return self._run_per_item(lambda itemid: self.remove_shortcut(itemid, parentid), itemids, workers)
+
+    #
+    # Call func(itemid) for each item ID with a pool of worker threads, collecting a
+    # {'id', 'ok', 'error'} status entry for each
+    #
+    def _run_per_item(self, func, itemids, workers):
+        def run(itemid):
+            try:
+                func(itemid)
+                return {'id': itemid, 'ok': True, 'error': None}
+            except Exception as e:
+                return {'id': itemid, 'ok': False, 'error': str(e)}
+
+        if workers <= 1 or len(itemids) <= 1:
+            return [run(itemid) for itemid in itemids]
+        with ThreadPoolExecutor(max_workers=min(workers, len(itemids))) as pool:
+            return list(pool.map(run, itemids))
 
     #
     # Upload a file to an existing Item in ScienceBase
@@ -258,20 +613,103 @@ class SbSession:
     #
     # Upload multiple files and create or update an Item in ScienceBase
     #
-    def upload_files_and_upsert_item(self, item, filenames, scrape_file=True):
+    # For very large files pass part_size: the files are then streamed from disk part_size
+    # bytes at a time instead of being handed to requests whole, progress(filename,
+    # bytes_sent, file_size) is called after each part, and a request that could not reach
+    # ScienceBase, or was turned away with 429 or 503, is resent up to retries times with
+    # delays from the session's retry policy.  ScienceBase takes the files of an upload in
+    # a single request, so a retry resends that whole request.  Other failures, which may
+    # come after the server has attached the files, are not retried, so as not to attach
+    # them twice.
+    #
+    # With upload deduplication enabled (see enable_upload_dedup) files already attached
+    # to an existing item with the same content are not sent again.
+    #
+    def upload_files_and_upsert_item(self, item, filenames, scrape_file=True, part_size=None, progress=None,
+                                     retries=3):
         url = self._base_upload_file_url
-        files = []
-        for filename in filenames:
-            if (os.access(filename, os.F_OK)):
-                files.append(('file', open(filename, 'rb')))
-            else:
-                raise Exception("File not found: " + filename)
-        data = {'item': json.dumps(item)}
-        params = {} if scrape_file is True else {'scrapeFile':'false'}
-        if 'id' in item and item['id']:
-            data['id'] = item['id']
-        ret = self._session.post(url, params=params, files=files, data=data)
-        return self._get_json(ret)
+        dedup = self._upload_dedup
+        if dedup is not None and item.get('id'):
+            for filename in filenames:
+                if not os.access(filename, os.F_OK):
+                    raise Exception("File not found: " + filename)
+            filenames = dedup.not_uploaded(item['id'], self._item_file_entries(item), filenames)
+            if not filenames:
+                return self.update_item(item) if len(item) > 1 else self.get_item(item['id'])
+        if part_size:
+            fields = [('item', self._json.encode(item))]
+            if 'id' in item and item['id']:
+                fields.append(('id', item['id']))
+            params = {} if scrape_file is True else {'scrapeFile':'false'}
+            ret = self._post_file_parts(url, params, fields, 'file', filenames, None, part_size, progress, retries)
+        else:
+            files = []
+            for filename in filenames:
+                if (os.access(filename, os.F_OK)):
+                    files.append(('file', open(filename, 'rb')))
+                else:
+                    raise Exception("File not found: " + filename)
+            data = {'item': self._json.encode(item)}
+            params = {} if scrape_file is True else {'scrapeFile':'false'}
+            if 'id' in item and item['id']:
+                data['id'] = item['id']
+            ret = self._session.post(url, params=params, files=files, data=data)
+        self._invalidate_items([item.get('id')])
+        retval = self._get_json(ret)
+        if dedup is not None and retval.get('id'):
+            for filename in filenames:
+                dedup.record_upload(retval['id'], filename)
+        return retval
+
+    #
+    # Turn on upload deduplication.  Before files are uploaded to an existing item they are
+    # hashed (streamed, by up to workers threads) and compared with the item's file
+    # entries: a file whose name, size and MD5 checksum match an attached file is skipped.
+    # Where the server reports no checksum, the hashes of earlier uploads recorded in the
+    # local cache file cache_path, if given, are used instead.  The cache also remembers
+    # the hashes of unchanged local files so they are not read again.
+    #
+    # Applies to upload_files_and_upsert_item and the calls built on it, and to
+    # replace_file, which skips the upload and the item update when the content is the same.
+    #
+    def enable_upload_dedup(self, cache_path=None, workers=4):
+        self._upload_dedup = _SbUploadDedup(cache_path, workers)
+        return self
+
+    #
+    # Turn off upload deduplication
+    #
+    def disable_upload_dedup(self):
+        self._upload_dedup = None
+
+    #
+    # Return the upload deduplication counters: files_skipped and bytes_saved
+    #
+    def upload_dedup_stats(self):
+        return self._upload_dedup.stats() if self._upload_dedup is not None else None
+
+    #
+    # Hash local files with the given hashlib algorithm, streaming each file and hashing
+    # up to workers files at once.  Returns a dictionary of file name to hex digest.
+    #
+    def hash_files(self, filenames, algorithm='md5', workers=4):
+        hash_file = partial(_hash_file, algorithm=algorithm)
+        if workers <= 1 or len(filenames) <= 1:
+            return dict((filename, hash_file(filename)) for filename in filenames)
+        with ThreadPoolExecutor(max_workers=min(workers, len(filenames))) as pool:
+            return dict(zip(filenames, pool.map(hash_file, filenames)))
+
+    #
+    # Return the raw file entries of an item, from its files list and its facets, reading
+    # them from ScienceBase if the given item JSON does not include them
+    #
+    def _item_file_entries(self, item):
+        if 'files' not in item and 'facets' not in item:
+            item = self.get_item(item['id'], {'fields': 'files,facets'})
+        entries = list(item.get('files', []))
+        for facet in item.get('facets', []):
+            entries.extend(facet.get('files', []))
+        return entries
 
 #  T.Wellman- def for file stream processing (beta 6-7-2017)
     # Retrieves content (file) from url as python file object
@@ -287,7 +725,25 @@ class SbSession:
     # optional provide filename when absent (to help preserve prov. no overwrite)
     # in **stream_kwargs pass:
     #      'filename_sub' = 'filenameHERE.fmt'
-    def upload_file_to_item_stream(self, item, stream_src, scrape_file=True, **stream_kwargs):
+    #
+    # pipe=True streams each source straight into the upload request instead of reading
+    # it into memory first.  Sources are opened one at a time as the multipart body is
+    # sent, so memory use stays bounded whatever the size of the files.
+    #
+    # pipeline=True fetches the sources concurrently, workers at a time, over a pooled
+    # connection of their own, and uploads each one in a post of its own as soon as it
+    # has arrived, while the others are still downloading.  Fetched data is held in
+    # memory up to max_buffer bytes in total and spilled to temporary files beyond that.
+    # Returns a report with the item JSON and, for each source in order, its name, size,
+    # fetch and upload times and any error.
+    def upload_file_to_item_stream(self, item, stream_src, scrape_file=True, pipe=False, pipeline=False,
+                                   workers=4, max_buffer=256 * 1024 * 1024, **stream_kwargs):
+
+        if pipeline:
+            return self._pipeline_files_to_item(item, stream_src, scrape_file, workers, max_buffer,
+                                                **stream_kwargs)
+        if pipe:
+            return self._pipe_files_to_item(item, stream_src, scrape_file, **stream_kwargs)
 
         files = []
         for i, proc_src in enumerate(stream_src):
@@ -311,12 +767,13 @@ class SbSession:
 
                 # attempt http or ftp request, else raise exception if unrecognized
                 if 'http' in proc_src:
+                    import requests
                     with closing(requests.get(proc_src, stream = True)) as r:
                         stream = BytesIO(r.content)
                         sc = r.status_code
                         hdr = r.headers
                 elif 'ftp' in proc_src:
-                    with closing(urlopen(proc_src)) as r:
+                    with closing(_urlopen(proc_src)) as r:
                         stream = BytesIO(r.read())
                     sc = r.code
                     hdr = r.info()
@@ -362,7 +819,7 @@ class SbSession:
                                                 proc_src.__class__.__name__)); return
 
         # retrieve response json from SB_item
-        data = {'item': json.dumps(item)}
+        data = {'item': self._json.encode(item)}
         params = {} if scrape_file is True else {'scrapeFile':'false'}
         if 'id' in item and item['id']:
             data['id'] = item['id']
@@ -373,6 +830,30 @@ class SbSession:
             ret = self._session.post(url, params=params, files=files, data=data)
         except Exception as e:
             print(e); return
+        self._invalidate_items([item.get('id')])
+
+        # ** optional report ** of POST request info
+        if "post_info" in stream_kwargs:
+            print("\n{}\n\{}\n{}\n\{}".format('POST status code: ', ret.status_code, 'POST info: ', ret.headers))
+        print("\n\n{}".format( '** ** Stream upload to ScienceBase complete.'))
+
+        return self._get_json(ret)
+
+    #
+    # Pipe mode of upload_file_to_item_stream: post the sources as a streamed multipart
+    # body to file/uploadAndUpsertItem
+    #
+    def _pipe_files_to_item(self, item, stream_src, scrape_file=True, **stream_kwargs):
+        fields = [('item', self._json.encode(item))]
+        if 'id' in item and item['id']:
+            fields.append(('id', item['id']))
+        files = [('file', None, partial(self._open_stream_source, item, i, proc_src, **stream_kwargs), None, None)
+                 for i, proc_src in enumerate(stream_src)]
+        body = _MultipartStream(fields, files)
+        params = {} if scrape_file is True else {'scrapeFile':'false'}
+        ret = self._session.post(self._base_upload_file_url, params=params, data=body,
+                                 headers={'Content-Type': body.content_type})
+        self._invalidate_items([item.get('id')])
 
         # ** optional report ** of POST request info
         if "post_info" in stream_kwargs:
@@ -381,20 +862,151 @@ class SbSession:
 
         return self._get_json(ret)
 
+    #
+    # Pipeline mode of upload_file_to_item_stream.  Uploads go one at a time, in the order
+    # the sources finish downloading, so that each upsert of the item sees the files
+    # added by the one before; the first creates the item if it has no ID yet.
+    #
+    def _pipeline_files_to_item(self, item, stream_src, scrape_file, workers, max_buffer, **stream_kwargs):
+        stream_src = list(stream_src)
+        budget = _ByteBudget(max_buffer)
+        report = [{'source': src if isinstance(src, str) else None, 'name': None, 'bytes': None,
+                   'fetch_time': None, 'upload_time': None, 'error': None} for src in stream_src]
+        params = {} if scrape_file is True else {'scrapeFile':'false'}
+        # Remote sources are fetched without the ScienceBase login or rate limit, and retried
+        # with a policy of their own so that they don't draw on the session's retry budget
+        from SbHttp import _SbRequestsSession, _SbHTTPAdapter
+        policy = self._retry_policy
+        fetch_policy = SbRetryPolicy(policy.max_retries, policy.backoff, policy.max_backoff, policy.max_retry_after,
+                                     policy.retry_statuses, policy.retry_methods, policy.budget_ratio,
+                                     policy.min_budget)
+        fetch_session = _SbRequestsSession(fetch_policy, None, self._timeout)
+        adapter = _SbHTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        fetch_session.mount('https://', adapter)
+        fetch_session.mount('http://', adapter)
+        start = time.time()
+
+        def fetch(i):
+            t = time.time()
+            try:
+                filename, src, close = self._open_stream_source(item, i, stream_src[i], fetch_session,
+                                                                **stream_kwargs)
+                try:
+                    spool = _BudgetedSpool(budget)
+                    try:
+                        for chunk in iter(partial(src.read, 1024 * 1024), b''):
+                            spool.write(chunk)
+                    except Exception:
+                        spool.close()
+                        raise
+                finally:
+                    close()
+            finally:
+                report[i]['fetch_time'] = time.time() - t
+            report[i].update({'name': filename, 'bytes': spool.size})
+            return filename, spool
+
+        retval = dict(item)
+        # The caller's item JSON goes with the first upload to succeed; later ones only
+        # name the item, so as not to undo changes made by the uploads in between
+        item_sent = False
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(stream_src)))) as pool:
+                futures = dict((pool.submit(fetch, i), i) for i in range(len(stream_src)))
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        filename, spool = future.result()
+                    except Exception as e:
+                        report[i]['error'] = str(e)
+                        continue
+                    t = time.time()
+                    try:
+                        fields = [('item', self._json.encode({'id': retval['id']} if item_sent else item))]
+                        if retval.get('id'):
+                            fields.append(('id', retval['id']))
+                        spool.seek(0)
+                        body = _MultipartStream(fields, [('file', filename, lambda: (filename, spool, lambda: None),
+                                                          spool.size, None)])
+                        ret = self._session.post(self._base_upload_file_url, params=params, data=body,
+                                                 headers={'Content-Type': body.content_type})
+                        retval = self._get_json(ret)
+                        item_sent = True
+                        self._invalidate_items([retval.get('id')])
+                    except Exception as e:
+                        report[i]['error'] = str(e)
+                    finally:
+                        spool.close()
+                        report[i]['upload_time'] = time.time() - t
+        finally:
+            fetch_session.close()
+        print("\n\n{}".format( '** ** Stream upload to ScienceBase complete.'))
+        return {'item': retval, 'sources': report, 'elapsed': time.time() - start}
+
+    #
+    # Open one source of upload_file_to_item_stream for reading.  Returns the file name
+    # to upload it as, a file-like object to read it from, and a function to close it.
+    # HTTP sources are fetched with the given requests session, if any.
+    #
+    def _open_stream_source(self, item, i, proc_src, session=None, **stream_kwargs):
+        filename_sub = stream_kwargs.get('filename_sub')
+        if isinstance(proc_src, BytesIO):
+            print("\n{}{}\n".format( '** ** Attempting to stream BytesIO file object to sb_item: ', item.get('id')))
+            proc_src.seek(0)
+            return (filename_sub[i] if filename_sub else None) or 'file', proc_src, lambda: None
+
+        if not isinstance(proc_src, str):
+            raise Exception("{}\t{}".format('** ** URL/request format was not recognized - type: ',
+                                            proc_src.__class__.__name__))
+
+        print("\n{}{}{}\n\n{}".format( '** ** Attempting to stream url response to sb_item: ',
+            item.get('id'), ' from url: ', str(proc_src)))
+        if proc_src.startswith('http'):
+            if session is None:
+                import requests as session
+            r = session.get(proc_src, stream=True)
+            r.raise_for_status()
+            r.raw.decode_content = True
+            src, sc, hdr = r.raw, r.status_code, r.headers
+        elif proc_src.startswith('ftp'):
+            r = _urlopen(proc_src)
+            src, sc, hdr = r, r.code, r.info()
+        else:
+            raise Exception('** ** url request format was not recognized ')
+
+        # ** optional report ** of GET request info
+        if "get_info" in stream_kwargs:
+            print("\n{}\n\{}\n{}\n\{}".format('GET status code: ', sc, 'GET info: ', hdr))
+
+        # determine filename
+        if 'content-disposition' in hdr:
+            filename = ''.join(findall("filename=(.+)", hdr['content-disposition']))
+        elif filename_sub and filename_sub[i] is not None:
+            filename = filename_sub[i]
+        else:
+            filename = 'file'
+        return filename, src, r.close
+
     #
     # Upload a file to ScienceBase.  The file will be staged in a temporary area.  In order
     # to attach it to an Item, the pathOnDisk must be added to an Item files entry, or
     # one of a facet's file entries.
     #
-    def upload_file(self, filename, mimetype=None):
+    # part_size, progress and retries work as for upload_files_and_upsert_item.
+    #
+    def upload_file(self, filename, mimetype=None, part_size=None, progress=None, retries=3):
         retval = None
         url = self._base_upload_file_temp_url
 
-        if (os.access(filename, os.F_OK)):
+        if part_size:
+            ret = self._post_file_parts(url, {}, [], 'files[]', [filename], mimetype, part_size, progress, retries)
+            retval = self._get_json(ret)
+        elif (os.access(filename, os.F_OK)):
             #
             # if no mimetype was sent in, try to guess
             #
             if None == mimetype:
+                import mimetypes
                 mimetype = mimetypes.guess_type(filename)
             (path, fname) = os.path.split(filename)
             ret = self._session.post(url, files=[('files[]', (fname, open(filename, 'rb'), mimetype))])
@@ -403,12 +1015,60 @@ class SbSession:
             raise Exception("File not found: " + filename)
         return retval
 
+    #
+    # Post local files as a multipart body streamed from disk in part_size pieces, resending
+    # the request, with delays from the session's retry policy, only where it was clearly
+    # not processed: it failed to connect, or got a 429 or 503 response
+    #
+    def _post_file_parts(self, url, params, fields, name, filenames, mimetype, part_size, progress, retries):
+        for filename in filenames:
+            if not os.access(filename, os.F_OK):
+                raise Exception("File not found: " + filename)
+
+        def opener(filename):
+            f = open(filename, 'rb')
+            return os.path.basename(filename), f, f.close
+
+        attempt = 0
+        while True:
+            files = [(name, os.path.basename(filename), partial(opener, filename), os.path.getsize(filename), mimetype)
+                     for filename in filenames]
+            body = _MultipartStream(fields, files, part_size, progress)
+            try:
+                ret = self._session.post(url, params=params, data=body, headers={'Content-Type': body.content_type})
+            except Exception as e:
+                if attempt >= retries or not _connect_failed(e):
+                    raise
+                delay = self._retry_policy.next_delay(None, attempt, error=True)
+                if delay is None:
+                    raise
+            else:
+                if attempt >= retries or ret.status_code not in (429, 503):
+                    return ret
+                delay = self._retry_policy.next_delay(None, attempt, status=ret.status_code,
+                                                      retry_after=ret.headers.get('Retry-After'))
+                if delay is None:
+                    return ret
+                ret.close()
+            time.sleep(delay)
+            attempt += 1
+
     #
     # Replace a file on a ScienceBase Item.  This method will replace all files named
     # the same as the new file, whether they are in the files list or on a facet.
     #
     def replace_file(self, filename, item):
         (path, fname) = os.path.split(filename)
+        dedup = self._upload_dedup
+        if dedup is not None:
+            entries = [f for f in self._item_file_entries(item) if f.get('name') == fname]
+            if entries and all(dedup.is_uploaded(item.get('id'), [f], filename) for f in entries):
+                dedup.skipped(filename)
+                return
+        #
+        # Only the files and facets that hold the file are sent in the update
+        #
+        changes = {'id': item['id']}
         #
         # replace file in files list
         #
@@ -417,6 +1077,7 @@ class SbSession:
             for f in item['files']:
                 if f['name'] == fname:
                     f = self._replace_file(filename, f)
+                    changes['files'] = new_files
                 new_files.append(f)
             item['files'] = new_files
         #
@@ -430,11 +1091,15 @@ class SbSession:
                     for f in facet['files']:
                         if f['name'] == fname:
                             f = self._replace_file(filename, f)
+                            changes['facets'] = new_facets
                         new_files.append(f)
                     facet['files'] = new_files
-                    new_facets.append(facet)
+                new_facets.append(facet)
             item['facets'] = new_facets
-        self.update_item(item)
+        if len(changes) > 1:
+            self.update_item(changes)
+            if dedup is not None:
+                dedup.record_upload(item['id'], filename)
 
 
 
@@ -453,9 +1118,10 @@ class SbSession:
 
     #
     # Download all files from a ScienceBase Item as a zip.  The zip is created server-side
-    # and streamed to the client.
+    # and streamed to the client.  With resume=True the download goes to <id>.zip.part
+    # and an interrupted download continues where it stopped, if the server allows it.
     #
-    def get_item_files_zip(self, item, destination='.'):
+    def get_item_files_zip(self, item, destination='.', resume=False):
         #
         # First check that there are files attached to the item, otherwise the call
         # to ScienceBase will return an empty zip file
@@ -467,19 +1133,51 @@ class SbSession:
         #
         # Download the zip
         #
-        r = self._session.get(self._base_download_files_url + item['id'], stream=True)
         local_filename = os.path.join(destination, item['id'] + ".zip")
-
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-                    f.flush()
+        self._download(self._base_download_files_url + item['id'], local_filename, 1024 * 1024, resume=resume)
         return local_filename
 
+    #
+    # Download all files from a ScienceBase Item as a zip, extracting the members into
+    # destination as the zip streams in, without writing the archive to disk.  Yields the
+    # local path of each member as soon as it has been extracted, so it can be processed
+    # while the rest of the zip is still downloading.  If members is given, only members
+    # with those names are kept, and the download stops once all of them are extracted.
+    #
+    def iter_item_files_zip(self, item, destination='.', members=None, chunk_size=1024 * 1024):
+        if not self.get_item_file_info(item):
+            return
+        wanted = set(members) if members is not None else None
+        with closing(self._session.get(self._base_download_files_url + item['id'], stream=True)) as r:
+            self._check_errors(r)
+            reader = _ZipStreamReader(r.iter_content(chunk_size=chunk_size))
+            for name, data in reader:
+                if wanted is not None and name not in wanted:
+                    for chunk in data:
+                        pass
+                    continue
+                local_filename = os.path.join(destination, _safe_zip_member_path(name))
+                if name.endswith('/'):
+                    if not os.path.isdir(local_filename):
+                        os.makedirs(local_filename)
+                    for chunk in data:
+                        pass
+                    continue
+                if os.path.dirname(local_filename) and not os.path.isdir(os.path.dirname(local_filename)):
+                    os.makedirs(os.path.dirname(local_filename))
+                with open(local_filename + '.part', 'wb') as f:
+                    for chunk in data:
+                        f.write(chunk)
+                os.replace(local_filename + '.part', local_filename)
+                yield local_filename
+                if wanted is not None:
+                    wanted.discard(name)
+                    if not wanted:
+                        break
+
     #
     # Retrieve file information from a ScienceBase Item.  Returns a list of dictionaries
-    # containing url, name and size of each file.
+    # containing url, name, size and dateUploaded of each file.
     #
     def get_item_file_info(self, item):
         retval = []
@@ -496,6 +1194,8 @@ class SbSession:
                         finfo['name'] = f['name']
                     if 'size' in f:
                         finfo['size'] = f['size']
+                    if 'dateUploaded' in f:
+                        finfo['dateUploaded'] = f['dateUploaded']
                     retval.append(finfo)
             if 'facets' in item:
                 for facet in item['facets']:
@@ -508,32 +1208,234 @@ class SbSession:
                                 finfo['name'] = f['name']
                             if 'size' in f:
                                 finfo['size'] = f['size']
+                            if 'dateUploaded' in f:
+                                finfo['dateUploaded'] = f['dateUploaded']
                             retval.append(finfo)
         return retval
 
     #
     # Download file from URL
     #
-    def download_file(self, url, local_filename, destination='.'):
+    # With resume=True the file is written to <local_filename>.part, which is renamed
+    # once complete.  If the .part file already exists, for example after a dropped
+    # connection, the download continues from its end with an HTTP Range request.
+    #
+    # With segments > 1 the file is split into that many byte ranges which are fetched
+    # concurrently into the .part file.  The progress of each range is kept in
+    # <local_filename>.part.segments, so an interrupted segmented download also resumes.
+    # size is the file size in bytes, as reported by get_item_file_info; when it is not
+    # given it is looked up with a HEAD request.  Servers that do not support ranges get
+    # a single ordinary download.
+    #
+    def download_file(self, url, local_filename, destination='.', chunk_size=1024 * 1024, fsync=False,
+                      resume=False, segments=1, size=None):
         complete_name = os.path.join(destination, local_filename)
         print("downloading " + url + " to " + complete_name)
-        r = self._session.get(url, stream=True)
-
-        with open(complete_name, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-                    f.flush()
+        self._download(url, complete_name, chunk_size, fsync, resume, segments, size)
         return complete_name
 
     #
-    # Download the individual files attached to a ScienceBase Item
+    # Download the individual files attached to a ScienceBase Item.  Files are fetched
+    # by a pool of worker threads; see download_files for the options and the manifest
+    # that is returned.
     #
-    def get_item_files(self, item, destination='.'):
-        file_info = self.get_item_file_info(item)
-        for file_info in file_info:
-            self.download_file(file_info['url'], file_info['name'], destination)
-        return file_info
+    def get_item_files(self, item, destination='.', workers=4, chunk_size=1024 * 1024, fsync=False,
+                       resume=False, segments=1):
+        return self.download_files(self.get_item_file_info(item), destination, workers, chunk_size, fsync,
+                                   resume, segments)
+
+    #
+    # Download a list of files, as returned by get_item_file_info, with a pool of worker
+    # threads.  Each file is streamed to disk in chunk_size pieces, and with fsync=True
+    # is synced to stable storage once complete.  resume and segments are passed on to
+    # download_file, along with the size of each file.
+    #
+    # Files are saved under the names given by local_file_names, so files with the same
+    # name don't overwrite each other.  To download only some of an item's files under
+    # the names they have among all of them, pass those names as local_names.
+    #
+    # Returns a manifest with one entry per file, in the order given, holding the url,
+    # name, local path, whether the file was renamed, bytes transferred, elapsed
+    # seconds, throughput in bytes per second and the error message if the download
+    # failed (otherwise None).
+    #
+    def download_files(self, file_info, destination='.', workers=4, chunk_size=1024 * 1024, fsync=False,
+                       resume=False, segments=1, local_names=None):
+        if local_names is None:
+            local_names = self.local_file_names(file_info)
+
+        def download(args):
+            finfo, local_name = args
+            result = {'url': finfo['url'], 'name': finfo['name'],
+                      'path': os.path.join(destination, local_name), 'renamed': local_name != finfo['name'],
+                      'bytes': 0, 'elapsed': 0.0, 'throughput': 0.0, 'error': None}
+            start = time.time()
+            try:
+                result['bytes'] = self._download(finfo['url'], result['path'], chunk_size, fsync,
+                                                 resume, segments, finfo.get('size'))
+            except Exception as e:
+                result['error'] = str(e)
+            result['elapsed'] = time.time() - start
+            if result['elapsed'] > 0:
+                result['throughput'] = result['bytes'] / result['elapsed']
+            return result
+
+        if workers <= 1 or len(file_info) <= 1:
+            return [download(args) for args in zip(file_info, local_names)]
+        with ThreadPoolExecutor(max_workers=min(workers, len(file_info))) as pool:
+            return list(pool.map(download, zip(file_info, local_names)))
+
+    #
+    # Local file names for a list of files, as returned by get_item_file_info.  An item
+    # can hold several files with the same name: the first keeps its name and the others
+    # become name_1.ext, name_2.ext and so on, in the order given, skipping names that
+    # are taken.
+    #
+    def local_file_names(self, file_info):
+        names = [finfo['name'] for finfo in file_info]
+        taken = set(os.path.normcase(name) for name in names)
+        used = set()
+        local_names = []
+        for name in names:
+            local_name = name
+            if os.path.normcase(name) in used:
+                stem, ext = os.path.splitext(name)
+                n = 1
+                while os.path.normcase('%s_%d%s' % (stem, n, ext)) in taken:
+                    n += 1
+                local_name = '%s_%d%s' % (stem, n, ext)
+                taken.add(os.path.normcase(local_name))
+            used.add(os.path.normcase(local_name))
+            local_names.append(local_name)
+        return local_names
+
+    #
+    # Download url into local file complete_name, segmented and/or resumable as requested.
+    # Returns the number of bytes transferred.
+    #
+    def _download(self, url, complete_name, chunk_size, fsync=False, resume=False, segments=1, size=None):
+        if segments > 1 or os.path.exists(complete_name + '.part.segments'):
+            if not size:
+                size = self._get_content_length(url)
+            if size and size > chunk_size:
+                nbytes = self._download_segments(url, complete_name, chunk_size, fsync, max(segments, 1), size)
+                if nbytes is not None:
+                    return nbytes
+        return self._download_stream(url, complete_name, chunk_size, fsync, resume)
+
+    #
+    # Stream url into complete_name, or into complete_name.part when resuming
+    #
+    def _download_stream(self, url, complete_name, chunk_size, fsync=False, resume=False):
+        part_name = complete_name + '.part' if resume else complete_name
+        offset = os.path.getsize(part_name) if resume and os.path.exists(part_name) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else None
+        nbytes = 0
+        with closing(self._session.get(url, stream=True, headers=headers)) as r:
+            if offset and r.status_code == 416:
+                # Nothing left to fetch if the .part file already holds the whole file
+                total = r.headers.get('Content-Range', '').split('/')[-1]
+                if total != str(offset):
+                    os.remove(part_name)
+                    return self._download_stream(url, complete_name, chunk_size, fsync, resume)
+            else:
+                if not (offset and r.status_code == 206):
+                    self._check_errors(r)
+                    offset = 0
+                with open(part_name, 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk: # filter out keep-alive new chunks
+                            f.write(chunk)
+                            nbytes += len(chunk)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+        if part_name != complete_name:
+            os.replace(part_name, complete_name)
+        return nbytes
+
+    #
+    # Fetch url in byte ranges concurrently into complete_name.part, recording progress in
+    # complete_name.part.segments.  Returns the number of bytes transferred, or None if
+    # the server does not honor range requests.
+    #
+    def _download_segments(self, url, complete_name, chunk_size, fsync, segments, size):
+        part_name = complete_name + '.part'
+        state_name = part_name + '.segments'
+        state = None
+        if os.path.exists(state_name) and os.path.exists(part_name):
+            with open(state_name) as f:
+                state = json.load(f)
+            if state.get('url') != url or state.get('size') != size:
+                state = None
+        if state is None:
+            seg_len = -(-size // segments)
+            ranges = [[start, min(start + seg_len, size) - 1] for start in range(0, size, seg_len)]
+            state = {'url': url, 'size': size, 'ranges': ranges, 'done': [0] * len(ranges)}
+            with open(part_name, 'wb') as f:
+                f.truncate(size)
+        lock = threading.Lock()
+
+        def save_state():
+            with lock:
+                with open(state_name + '.tmp', 'w') as f:
+                    json.dump(state, f)
+                os.replace(state_name + '.tmp', state_name)
+
+        def fetch(i):
+            start, end = state['ranges'][i]
+            pos = start + state['done'][i]
+            nbytes = 0
+            if pos > end:
+                return nbytes
+            with closing(self._session.get(url, stream=True, headers={'Range': 'bytes=%d-%d' % (pos, end)})) as r:
+                if r.status_code != 206:
+                    self._check_errors(r)
+                    return None
+                with open(part_name, 'r+b') as f:
+                    f.seek(pos)
+                    unsaved = 0
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            nbytes += len(chunk)
+                            unsaved += len(chunk)
+                            with lock:
+                                state['done'][i] += len(chunk)
+                            if unsaved >= 16 * chunk_size:
+                                f.flush()
+                                save_state()
+                                unsaved = 0
+            return nbytes
+
+        save_state()
+        try:
+            with ThreadPoolExecutor(max_workers=len(state['ranges'])) as pool:
+                results = list(pool.map(fetch, range(len(state['ranges']))))
+        finally:
+            save_state()
+        if None in results:
+            os.remove(part_name)
+            os.remove(state_name)
+            return None
+        for (start, end), done in zip(state['ranges'], state['done']):
+            if done != end - start + 1:
+                raise Exception("Incomplete download of " + url + ", rerun to resume")
+        if fsync:
+            with open(part_name, 'r+b') as f:
+                os.fsync(f.fileno())
+        os.replace(part_name, complete_name)
+        os.remove(state_name)
+        return sum(results)
+
+    #
+    # Get the size of the resource at url from a HEAD request, or None if unknown
+    #
+    def _get_content_length(self, url):
+        r = self._session.head(url, allow_redirects=True)
+        if r.status_code == 200 and 'Content-Length' in r.headers:
+            return int(r.headers['Content-Length'])
+        return None
 
     #
     # Get the ID of the logged-in user's My Items
@@ -553,43 +1455,79 @@ class SbSession:
     # Get IDs of all immediate children for a given parent
     #
     def get_child_ids(self, parentid):
-        retval = []
-        items = self.find_items({'filter':'parentIdExcludingLinks=' + parentid, 'max': self._max_item_count})
-        while items and 'items' in items:
-            for item in items['items']:
-                retval.append(item['id'])
-            items = self.next(items)
-        return retval
+        params = {'filter': 'parentIdExcludingLinks=' + parentid, 'fields': 'id', 'max': self._max_item_count}
+        return [item['id'] for item in self.iter_items(params)]
 
     #
     # Get IDs of all descendants of given item excluding those which are linked in (short-cutted). (finds items by ancestorsExcludingLinks)
     #
     def get_ancestor_ids(self, parentid):
-        retval = []
-        items = self.find_items({'filter':'ancestorsExcludingLinks=' + parentid, 'max': self._max_item_count})
-        while items and 'items' in items:
-            for item in items['items']:
-                retval.append(item['id'])
-            items = self.next(items)
-        return retval
+        params = {'filter': 'ancestorsExcludingLinks=' + parentid, 'fields': 'id', 'max': self._max_item_count}
+        return [item['id'] for item in self.iter_items(params)]
 
     #
     # Get IDs of all shortcutted items for a given item
     #
     def get_shortcut_ids(self, itemid):
-        retval = []
-        items = self.find_items({'filter':'linkParentId=' + itemid})
-        while items and 'items' in items:
-            for item in items['items']:
-                retval.append(item['id'])
-            items = self.next(items)
-        return retval
+        params = {'filter': 'linkParentId=' + itemid, 'fields': 'id', 'max': self._max_item_count}
+        return [item['id'] for item in self.iter_items(params)]
+
+    #
+    # Walk the tree of items below root_id breadth first, yielding (item, depth, parentid)
+    # for the root (depth 0, parentid None) and every descendant as it is found.
+    #
+    # The children of each level are fetched with up to workers searches in flight, and
+    # items are yielded as each parent's children arrive.  max_depth limits how many levels
+    # below the root are visited (None for all).  fields is a comma separated string or
+    # list of the item fields to fetch; without it the server's default search fields are
+    # returned.  With include_shortcuts=True items shortcutted into a parent (found by
+    # linkParentId, as for get_shortcut_ids) are walked too.  Each item is visited once,
+    # so shortcut cycles do not loop.
+    #
+    def walk_tree(self, root_id, max_depth=None, fields=None, workers=4, include_shortcuts=False):
+        if fields is not None and not isinstance(fields, str):
+            fields = ','.join(fields)
+        root = self.get_item(root_id, {'fields': fields} if fields else None)
+        yield root, 0, None
+
+        def children(parentid):
+            filters = ['parentIdExcludingLinks=' + parentid]
+            if include_shortcuts:
+                filters.append('linkParentId=' + parentid)
+            retval = []
+            for f in filters:
+                params = {'filter': f, 'max': self._max_item_count}
+                if fields:
+                    params['fields'] = fields
+                retval.extend(self.iter_items(params, prefetch=0))
+            return retval
+
+        visited = set([root_id])
+        level = [root_id]
+        depth = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while level and (max_depth is None or depth < max_depth):
+                depth += 1
+                futures = dict((pool.submit(children, parentid), parentid) for parentid in level)
+                level = []
+                try:
+                    for future in as_completed(futures):
+                        for item in future.result():
+                            if item['id'] in visited:
+                                continue
+                            visited.add(item['id'])
+                            level.append(item['id'])
+                            yield item, depth, futures[future]
+                finally:
+                    for future in futures:
+                        future.cancel()
 
     #
     # Create a shortcut to another item
     #
     def create_shortcut(self, itemid, parentid):
         ret = self._session.post(self._base_shortcut_item_url, params={'itemId':itemid, 'destId':parentid})
+        self._invalidate_items([itemid])
         return self._get_json(ret)
 
     #
@@ -597,6 +1535,7 @@ class SbSession:
     #
     def remove_shortcut(self, itemid, parentid):
         ret = self._session.post(self._base_unlink_item_url, params={'itemId':itemid, 'destId':parentid})
+        self._invalidate_items([itemid])
         return self._get_json(ret)
 
     #
@@ -624,22 +1563,64 @@ class SbSession:
     # they are stored in the feature_geojson['properties'] dict.
     #
     def add_extent(self, item_id, feature_geojson):
-        features = feature_geojson['features'] if feature_geojson['type'] == "FeatureCollection" else [feature_geojson]
-        # Get the item from ScienceBase
-        item = self.get_item(item_id)
-        # Save the existing item extents
-        extents = item['extents'] if 'extents' in item else []
-        for feature in features:
-            # Create the new extent, which will overwrite the exiting extent ID list
-            item['extents'] = [feature]
-            item = self.update_item(item)
-            extents.extend(item['extents'])
-        # If there were extents on the item, add them back
-        if len(extents) > 1:
-            item['extents'] = extents
-            item = self.update_item(item)
-        # Return the item JSON
-        return item
+        return self.add_extents(item_id, feature_geojson)
+
+    #
+    # Create extents from many features and add them to the item's footprint, in a bounded
+    # number of round trips.  Features are sent in batches of up to batch_size features
+    # and max_bytes of JSON, each batch in one update of just the item's extents, which
+    # creates an extent per feature; a final update puts the item's earlier extents back
+    # alongside the new ones.
+    #
+    # features may be a Feature or FeatureCollection dict, an iterable of Feature dicts,
+    # or the name of (or an open file holding) a GeoJSON file, which is read feature by
+    # feature so that large FeatureCollections are never loaded whole.
+    #
+    def add_extents(self, item_id, features, batch_size=100, max_bytes=5 * 1024 * 1024):
+        # Only the extent IDs of the item are needed
+        item = self.get_item(item_id, {'fields': 'extents'})
+        extents = list(item.get('extents', []))
+        batch = []
+        batch_bytes = 0
+        for feature in self.iter_geojson_features(features):
+            size = len(self._json.encode(feature))
+            if batch and (len(batch) >= batch_size or batch_bytes + size > max_bytes):
+                item = self.update_item({'id': item_id, 'extents': batch})
+                extents.extend(item.get('extents', []))
+                batch = []
+                batch_bytes = 0
+            batch.append(feature)
+            batch_bytes += size
+        if batch:
+            item = self.update_item({'id': item_id, 'extents': batch})
+            extents.extend(item.get('extents', []))
+        # Each batch replaced the item's extent list, so put back the full list unless the
+        # only batch already holds it
+        if item.get('extents', []) != extents:
+            item = self.update_item({'id': item_id, 'extents': extents})
+        return item if 'title' in item else self.get_item(item_id)
+
+    #
+    # Iterate over the features of GeoJSON given as a Feature or FeatureCollection dict,
+    # an iterable of Feature dicts, or a file name or open file.  Files are parsed
+    # incrementally: only the current feature is held in memory.
+    #
+    def iter_geojson_features(self, source):
+        if isinstance(source, dict):
+            features = source['features'] if source.get('type') == 'FeatureCollection' else [source]
+            for feature in features:
+                yield feature
+        elif isinstance(source, str) or hasattr(source, 'read'):
+            f = open(source) if isinstance(source, str) else source
+            try:
+                for value in iter_json_array(f, 'features'):
+                    yield value
+            finally:
+                if f is not source:
+                    f.close()
+        else:
+            for feature in source:
+                yield feature
 
     #
     # Search for ScienceBase items
@@ -665,6 +1646,102 @@ class SbSession:
             ret_val = self._get_json(self._session.get(self._remove_josso_param(items['prevlink']['url'])))
         return ret_val
 
+    #
+    # Iterate over every ScienceBase item matching a search, one item at a time.
+    #
+    # A background thread follows the nextlink chain and keeps up to prefetch pages
+    # buffered ahead of the caller, so the round trip for the next page overlaps with
+    # processing of the current one.  At most prefetch + 1 pages are held in memory.
+    # With prefetch=0 pages are fetched in the calling thread as they are needed.
+    # Closing the generator early stops the background thread.
+    #
+    # With stream=True each page is parsed incrementally as it is received, and its items
+    # are passed on in batches of up to 100, so that neither the text of a whole page nor
+    # all of its items need be held at once.  prefetch then counts batches.
+    #
+    def iter_items(self, params, prefetch=2, stream=False):
+        batches = self._iter_item_batches(params) if stream else \
+            (page['items'] for page in self._iter_pages(params))
+        if prefetch < 1:
+            for batch in batches:
+                for item in batch:
+                    yield item
+            return
+
+        pages = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_pages, args=(batches, pages, stop))
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                for item in page:
+                    yield item
+        finally:
+            stop.set()
+
+    #
+    # Fetch search result pages in order by following the nextlink of each page
+    #
+    def _iter_pages(self, params):
+        items = self.find_items(params)
+        while items and 'items' in items:
+            yield items
+            items = self.next(items)
+
+    #
+    # Fetch the items of a search page by page, parsing each response as it streams in
+    # and yielding lists of up to batch_size items
+    #
+    def _iter_item_batches(self, params, batch_size=100):
+        url, request_params = self._base_items_url, params
+        while url:
+            rest = {}
+            with closing(self._session.get(url, params=request_params, stream=True)) as r:
+                self._check_errors(r)
+                r.raw.decode_content = True
+                batch = []
+                for item in iter_json_array(r.raw, 'items', others=rest):
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+            url = self._remove_josso_param(rest['nextlink']['url']) if 'nextlink' in rest else None
+            request_params = None
+
+    #
+    # Background page reader for iter_items.  Pushes the item lists of batches onto the
+    # bounded queue, followed by any exception raised and finally None to mark the end
+    # of the search.
+    #
+    def _read_pages(self, batches, pages, stop):
+        def put(page):
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            # Releases the connection of a page being streamed if the caller stopped early
+            batches.close()
+        put(None)
+
     #
     # Search for ScienceBase items by free text
     #
@@ -731,7 +1808,7 @@ class SbSession:
     def _get_json(self, response):
         self._check_errors(response)
         try:
-            return response.json()
+            return self._json.decode(response.content)
         except:
             raise Exception("Error parsing JSON response: " + response.text)
 
@@ -746,46 +1823,56 @@ class SbSession:
             raise Exception("Error parsing response")
 
     #
-    # Retry in the case of a WAF error (503) or rate limiter (429)
+    # Call f(*args), retrying it when it fails in a way that may pass, with delays from the
+    # session's retry policy.  Requests are already retried by the session where that is
+    # safe; use this for calls that are not, such as a POST known to be safe to repeat.
+    # Only connection errors, timeouts and the retry policy's retry_statuses (429 and
+    # gateway errors by default) are retried; anything else is raised at once.  Returns
+    # what f returns.
     #
     def retry_on_error(self, f, *args):
-        self._retry = True
-        retry_time = 60
-        try:
-            while self._retry:
-                try:
-                    response = f(*args)
-                    self._retry = False
-                except:
-                    if response.status_code == '503':
-                        print('\twaiting for WAF...')
-                        time.sleep(retry_time)
-                    elif response.status_code == '429':
-                        print('\twaiting for ScienceBase rate limiter...')
-                        time.sleep(retry_time)
-                if not done:
-                    print('\tretrying...')
-                    retry_time *= 2
-        except:
-            raise
-        finally:
-            self._retry = False
+        import requests
+        attempt = 0
+        while True:
+            try:
+                return f(*args)
+            except Exception as e:
+                error = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+                status = getattr(e, 'status_code', None)
+                if not error and status is None:
+                    raise
+                delay = self._retry_policy.next_delay(None, attempt, status=status,
+                                                      retry_after=getattr(e, 'retry_after', None), error=error)
+                if delay is None:
+                    raise
+            print('\tretrying in %.1f seconds...' % delay)
+            time.sleep(delay)
+            attempt += 1
+
+    #
+    # Return the retry counters of the session's retry policy, see SbRetryPolicy.stats
+    #
+    def retry_stats(self):
+        return self._retry_policy.stats()
 
     #
     # Check the status code of the response
     #
     def _check_errors(self, response):
         if (response.status_code == 404):
-            raise Exception("Resource not found, or user does not have access")
+            error = Exception("Resource not found, or user does not have access")
         elif (response.status_code == 401):
-            raise Exception("Unauthorized access")
+            error = Exception("Unauthorized access")
         elif (response.status_code == 429):
-            raise Exception("Too many requests")
+            error = Exception("Too many requests")
         elif (response.status_code != 200):
-            if self._retry:
-                return response
-            else:
-                raise Exception("Other HTTP error: " + str(response.status_code) + ": " + response.text)
+            error = Exception("Other HTTP error: " + str(response.status_code) + ": " + response.text)
+        else:
+            return
+        # For retry_on_error, to tell failures that may pass from those that won't
+        error.status_code = response.status_code
+        error.retry_after = response.headers.get('Retry-After')
+        raise error
 
     #
     # Remove josso parameter from URL
@@ -795,6 +1882,21 @@ class SbSession:
         q = [x for x in urlparse.parse_qsl(o.query) if "josso" not in x]
         return urlparse.urlunsplit((o.scheme, o.netloc, o.path, urlencode(q), o.fragment))
 
+    #
+    # Return the request metrics aggregated per method and endpoint class; see SbMetrics
+    #
+    def stats(self):
+        return self._metrics.stats()
+
+    #
+    # Call hook(event) after every request; see SbMetrics for the event fields
+    #
+    def add_request_hook(self, hook):
+        self._metrics.add_hook(hook)
+
+    def remove_request_hook(self, hook):
+        self._metrics.remove_hook(hook)
+
     #
     # Turn on HTTP logging for debugging purposes
     #
@@ -802,9 +1904,11 @@ class SbSession:
         # This line enables debugging at httplib level (requests->urllib3->httplib)
         # You will see the REQUEST, including HEADERS and DATA, and RESPONSE with HEADERS but without DATA.
         # The only thing missing will be the response.body which is not logged.
-        httplib.HTTPConnection.debuglevel = 1
+        import http.client
+        http.client.HTTPConnection.debuglevel = 1
 
         # You must initialize logging, otherwise you'll not see debug output.
+        import logging
         logging.basicConfig()
         logging.getLogger().setLevel(logging.DEBUG)
         requests_log = logging.getLogger("requests.packages.urllib3")
@@ -870,3 +1974,618 @@ class SbSession:
         return self.find_items_by_title(text)
     def getJson(self, response):
         return self.get_json(response)
+
+
+#
+# Pool of SbSessions for use from many threads.  Each thread that uses the pool gets its
+# own clone of session, so no requests state is shared between threads, while the login,
+# retry policy, rate limiter and item cache are shared.  Each clone keeps its own
+# connections alive, so workers reuse connections rather than opening new ones.
+#
+# map() runs on max_workers threads owned by the pool and kept between calls, so their
+# sessions and connections stay warm.  A thread's session passes to a later thread once
+# the first has ended, so the pool holds no more sessions than there are live threads
+# using it.
+#
+#     pool = SbSessionPool(SbSession().login(username, password), max_workers=32)
+#     items = pool.map(lambda sb, itemid: sb.get_item(itemid), ids)
+#
+class SbSessionPool(object):
+    def __init__(self, session, max_workers=8):
+        self._template = session
+        self._max_workers = max_workers
+        self._sessions = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    #
+    # The SbSession of the calling thread
+    #
+    @property
+    def session(self):
+        thread = threading.current_thread()
+        sb = self._sessions.get(thread)
+        if sb is None:
+            with self._lock:
+                ended = [t for t in self._sessions if not t.is_alive()]
+                sb = self._sessions.pop(ended[0]) if ended else self._template.clone()
+                self._sessions[thread] = sb
+        return sb
+
+    #
+    # Call func(session, arg) for each arg with max_workers threads, each using its own
+    # session.  Returns the results in order; the first exception raised is re-raised.
+    #
+    def map(self, func, iterable):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+            executor = self._executor
+        return list(executor.map(lambda arg: func(self.session, arg), iterable))
+
+    #
+    # Stop the worker threads and close the connections of every session handed out
+    #
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+        with self._lock:
+            for sb in self._sessions.values():
+                if sb._requests_session is not None:
+                    sb._requests_session.close()
+            self._sessions = {}
+
+
+_session_lock = threading.Lock()
+_version = []
+
+
+#
+# The installed version of the pysb distribution, or None, looked up once
+#
+def _pysb_version():
+    if not _version:
+        try:
+            from importlib.metadata import version, PackageNotFoundError
+        except ImportError:
+            # Python < 3.8
+            from pkg_resources import get_distribution as version, DistributionNotFound as PackageNotFoundError
+        try:
+            found = version("pysb")
+            _version.append(found if isinstance(found, str) else found.version)
+        except PackageNotFoundError:
+            _version.append(None)
+    return _version[0]
+
+
+#
+# Whether a requests exception means the request never reached the server: the
+# connection could not be opened
+#
+def _connect_failed(e):
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], 'reason', None), (ConnectTimeoutError, NewConnectionError))
+    return False
+
+
+def _urlopen(url):
+    from urllib.request import urlopen
+    return urlopen(url)
+
+
+#
+# Relative local path for a zip member name, refusing names that would land outside the
+# extraction directory
+#
+def _safe_zip_member_path(name):
+    path = os.path.normpath(name.replace('\\', '/').lstrip('/'))
+    if path == '..' or path.startswith('..' + os.sep) or os.path.isabs(path):
+        raise Exception("Unsafe zip member name: " + name)
+    return path
+
+
+#
+# Sequential reader of a zip archive arriving as an iterator of byte chunks.  Iterating
+# gives (name, data) for each member in turn, where data iterates over the member's
+# uncompressed bytes and must be consumed before moving on to the next member.  Reads
+# the local file headers only, so it works without the central directory at the end of
+# the archive; handles stored and deflated members, data descriptors and Zip64 sizes,
+# and checks each member's CRC.
+#
+class _ZipStreamReader(object):
+    _local_header = struct.Struct('<HHHHHIIIHH')
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+
+    def __iter__(self):
+        while True:
+            signature = self._read(4, eof_ok=True)
+            if signature in (b'', b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06'):
+                # Central directory or end of archive: no more members
+                return
+            if signature != b'PK\x03\x04':
+                raise Exception("Invalid zip stream: unexpected signature %r" % signature)
+            (version, flags, method, mtime, mdate, crc, csize, usize, name_len,
+             extra_len) = self._local_header.unpack(self._read(self._local_header.size))
+            name = self._read(name_len)
+            name = name.decode('utf-8') if flags & 0x800 else name.decode('cp437')
+            extra = self._read(extra_len)
+            zip64 = False
+            pos = 0
+            while pos + 4 <= len(extra):
+                header_id, size = struct.unpack('<HH', extra[pos:pos + 4])
+                if header_id == 1:
+                    zip64 = True
+                    values = extra[pos + 4:pos + 4 + size]
+                    if usize == 0xFFFFFFFF and len(values) >= 8:
+                        usize = struct.unpack('<Q', values[:8])[0]
+                        values = values[8:]
+                    if csize == 0xFFFFFFFF and len(values) >= 8:
+                        csize = struct.unpack('<Q', values[:8])[0]
+                pos += 4 + size
+            if flags & 1:
+                raise Exception("Encrypted zip members are not supported: " + name)
+            if method not in (0, 8):
+                raise Exception("Unsupported zip compression method %d: %s" % (method, name))
+            yield name, self._member_data(name, flags, method, crc, csize, zip64)
+
+    def _member_data(self, name, flags, method, crc, csize, zip64):
+        running_crc = 0
+        decompressor = zlib.decompressobj(-15) if method == 8 else None
+        if not flags & 8:
+            chunks = self._read_chunks(csize)
+        elif method == 8:
+            chunks = self._read_until_eof(decompressor)
+        else:
+            chunks = self._read_stored_until_descriptor(zip64)
+        for chunk in chunks:
+            data = decompressor.decompress(chunk) if decompressor else chunk
+            if data:
+                running_crc = zlib.crc32(data, running_crc)
+                yield data
+        if decompressor:
+            data = decompressor.flush()
+            if data:
+                running_crc = zlib.crc32(data, running_crc)
+                yield data
+        if flags & 8:
+            if method == 8:
+                descriptor = self._read(4)
+                if descriptor == b'PK\x07\x08':
+                    descriptor = self._read(4)
+                crc = struct.unpack('<I', descriptor)[0]
+                self._read(16 if zip64 else 8)
+            else:
+                crc = self._stored_crc
+        if running_crc & 0xFFFFFFFF != crc:
+            raise Exception("CRC mismatch in zip member: " + name)
+
+    def _read_chunks(self, n):
+        while n > 0:
+            if not self._buf:
+                self._fill()
+            chunk = self._buf[:n]
+            self._buf = self._buf[len(chunk):]
+            n -= len(chunk)
+            yield chunk
+
+    #
+    # Compressed data of a member of unknown size: feed the decompressor until it reports
+    # the end of the deflate stream, and put back whatever follows
+    #
+    def _read_until_eof(self, decompressor):
+        while True:
+            if not self._buf:
+                self._fill()
+            chunk = self._buf
+            self._buf = b''
+            yield chunk
+            if decompressor.eof:
+                self._buf = decompressor.unused_data + self._buf
+                return
+
+    #
+    # Stored data of a member of unknown size: it ends at a data descriptor whose CRC and
+    # size match the data before it
+    #
+    def _read_stored_until_descriptor(self, zip64):
+        descriptor_len = 24 if zip64 else 16
+        size_format = '<Q' if zip64 else '<I'
+        crc = 0
+        total = 0
+        start = 0
+        while True:
+            index = self._buf.find(b'PK\x07\x08', start)
+            if index < 0 or len(self._buf) < index + descriptor_len:
+                # Keep enough of the buffer to recognise a descriptor that spans chunks
+                keep = max(len(self._buf) - descriptor_len + 1, 0) if index < 0 else index
+                if keep:
+                    data = self._buf[:keep]
+                    crc = zlib.crc32(data, crc)
+                    total += len(data)
+                    self._buf = self._buf[keep:]
+                    yield data
+                start = 0
+                self._fill()
+                continue
+            data = self._buf[:index]
+            descriptor = self._buf[index:index + descriptor_len]
+            if struct.unpack('<I', descriptor[4:8])[0] == zlib.crc32(data, crc) & 0xFFFFFFFF and \
+                    struct.unpack(size_format, descriptor[8:8 + struct.calcsize(size_format)])[0] == total + len(data):
+                self._buf = self._buf[index + descriptor_len:]
+                self._stored_crc = zlib.crc32(data, crc) & 0xFFFFFFFF
+                if data:
+                    yield data
+                return
+            start = index + 1
+
+    def _read(self, n, eof_ok=False):
+        while len(self._buf) < n:
+            if not self._fill(eof_ok and not self._buf):
+                return b''
+        data = self._buf[:n]
+        self._buf = self._buf[n:]
+        return data
+
+    def _fill(self, eof_ok=False):
+        for chunk in self._chunks:
+            if chunk:
+                self._buf += chunk
+                return True
+        if eof_ok:
+            return False
+        raise Exception("Zip stream ended unexpectedly")
+
+
+#
+# Shared allowance of bytes that may be held in memory at once
+#
+class _ByteBudget(object):
+    def __init__(self, nbytes):
+        self._available = nbytes
+        self._lock = threading.Lock()
+
+    def try_reserve(self, nbytes):
+        with self._lock:
+            if nbytes > self._available:
+                return False
+            self._available -= nbytes
+            return True
+
+    def release(self, nbytes):
+        with self._lock:
+            self._available += nbytes
+
+
+#
+# Write-once, read-back buffer that keeps its data in memory while the shared budget
+# allows, and moves it to a temporary file when the budget runs out
+#
+class _BudgetedSpool(object):
+    def __init__(self, budget):
+        self._budget = budget
+        self._file = BytesIO()
+        self._reserved = 0
+        self.size = 0
+
+    def write(self, data):
+        if self._reserved is not None:
+            if self._budget.try_reserve(len(data)):
+                self._reserved += len(data)
+            else:
+                import tempfile
+                disk = tempfile.TemporaryFile()
+                disk.write(self._file.getvalue())
+                self._file = disk
+                self._budget.release(self._reserved)
+                self._reserved = None
+        self._file.write(data)
+        self.size += len(data)
+
+    def seek(self, pos):
+        self._file.seek(pos)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+        if self._reserved:
+            self._budget.release(self._reserved)
+        self._reserved = None
+
+
+#
+# Hex digest of a file's contents, read in 1 MB chunks
+#
+def _hash_file(filename, algorithm='md5'):
+    import hashlib
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(partial(f.read, 1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+#
+# Upload deduplication state for SbSession.enable_upload_dedup: hashes of local files,
+# hashes of earlier uploads, and counters.  Persisted to cache_path as JSON if given.
+#
+class _SbUploadDedup(object):
+    def __init__(self, cache_path=None, workers=4):
+        self._cache_path = cache_path
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._cache = {'local': {}, 'uploads': {}}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self._cache = json.load(f)
+        self.files_skipped = 0
+        self.bytes_saved = 0
+
+    #
+    # MD5 of a local file, reusing the cached value while its size and mtime are unchanged
+    #
+    def md5(self, filename):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        with self._lock:
+            cached = self._cache['local'].get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+        digest = _hash_file(path, 'md5')
+        with self._lock:
+            self._cache['local'][path] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    #
+    # Return the files that do not already match one of the given file entries of item
+    # itemid, counting the others as skipped.  Files that could match by name and size
+    # are hashed in parallel.
+    #
+    def not_uploaded(self, itemid, entries, filenames):
+        sizes = set((e.get('name'), e.get('size')) for e in entries)
+        candidates = [f for f in filenames if (os.path.basename(f), os.path.getsize(f)) in sizes]
+        if len(candidates) > 1 and self._workers > 1:
+            with ThreadPoolExecutor(max_workers=min(self._workers, len(candidates))) as pool:
+                list(pool.map(self.md5, candidates))
+        retval = []
+        for f in filenames:
+            if self.is_uploaded(itemid, entries, f):
+                self.skipped(f)
+            else:
+                retval.append(f)
+        return retval
+
+    #
+    # Whether filename already matches one of the given file entries of item itemid
+    #
+    def is_uploaded(self, itemid, entries, filename):
+        name = os.path.basename(filename)
+        size = os.path.getsize(filename)
+        candidates = [e for e in entries if e.get('name') == name and e.get('size') == size]
+        if not candidates:
+            return False
+        digest = self.md5(filename)
+        with self._lock:
+            uploaded = self._cache['uploads'].get('%s/%s' % (itemid, name))
+        for entry in candidates:
+            checksum = entry.get('checksum') or {}
+            if (checksum.get('type', 'MD5').upper() == 'MD5' and checksum.get('value') == digest) or \
+                    (not checksum.get('value') and uploaded == [size, digest]):
+                return True
+        return False
+
+    #
+    # Count filename as not uploaded because it was already there
+    #
+    def skipped(self, filename):
+        size = os.path.getsize(filename)
+        with self._lock:
+            self.files_skipped += 1
+            self.bytes_saved += size
+
+    #
+    # Remember the hash of a file uploaded to item itemid
+    #
+    def record_upload(self, itemid, filename):
+        digest = self.md5(filename)
+        with self._lock:
+            self._cache['uploads']['%s/%s' % (itemid, os.path.basename(filename))] = \
+                [os.path.getsize(filename), digest]
+        self.save()
+
+    def save(self):
+        if self._cache_path:
+            with self._lock:
+                with open(self._cache_path + '.tmp', 'w') as f:
+                    json.dump(self._cache, f)
+                os.replace(self._cache_path + '.tmp', self._cache_path)
+
+    def stats(self):
+        with self._lock:
+            return {'files_skipped': self.files_skipped, 'bytes_saved': self.bytes_saved}
+
+
+#
+# Bounded LRU cache of item JSON used by SbSession.get_item; see
+# SbSession.enable_item_cache.  Entries are keyed by item ID and query parameters and
+# hold the raw response body, so each hit is parsed into a fresh copy the caller can
+# modify.  Safe to use from several threads.
+#
+class SbItemCache(object):
+    def __init__(self, max_items=1000, max_bytes=None, ttl=300):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    #
+    # Look up key, returning (entry, fresh).  entry is None on a miss; a stale entry is
+    # counted as a miss and returned with fresh=False so the caller can revalidate it.
+    #
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end(key)
+            if time.time() - entry['time'] < self.ttl:
+                self.hits += 1
+                return entry, True
+            self.misses += 1
+            return entry, False
+
+    #
+    # Add or replace the response body for key, evicting least recently used entries
+    #
+    def put(self, key, content, etag=None, last_modified=None):
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes is not None and len(content) > self.max_bytes:
+                return
+            self._entries[key] = {'content': content, 'etag': etag, 'last_modified': last_modified,
+                                  'time': time.time()}
+            self._bytes += len(content)
+            while len(self._entries) > self.max_items or \
+                    (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    #
+    # Mark the entry for key as fresh again after the server answered 304 Not Modified
+    #
+    def revalidated(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['time'] = time.time()
+            self.revalidations += 1
+
+    #
+    # Drop every entry for the given item ID
+    #
+    def invalidate(self, itemid):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == itemid]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidations,
+                    'evictions': self.evictions, 'items': len(self._entries), 'bytes': self._bytes}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry['content'])
+
+
+#
+# File-like multipart/form-data request body that is generated as it is read.  fields
+# is a list of (name, value) form fields; files is a list of (name, filename, opener,
+# size, content_type) tuples, where opener() returns (filename, file-like object, close
+# function).  filename, size and content_type may be None if they are only known once
+# the file is opened.  Each file is opened only when the body reaches it and is read
+# chunk_size bytes at a time, so no file is ever held whole in memory.
+# progress(filename, bytes_sent, size) is called after each chunk.
+#
+# When every file name and size is known up front the body has a len, and requests
+# sends it with a Content-Length header; otherwise it is sent with chunked transfer
+# encoding.
+#
+class _MultipartStream(object):
+    def __init__(self, fields, files, chunk_size=1024 * 1024, progress=None):
+        import uuid
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self._chunk_size = chunk_size
+        self._progress = progress
+        self._chunks = self._generate(fields, files)
+        self._buffer = b''
+        self._pos = 0
+        if all(filename is not None and size is not None for name, filename, opener, size, content_type in files):
+            self.len = (sum(len(self._field_part(name, value)) for name, value in fields) +
+                        sum(len(self._file_header(name, filename, content_type)) + size + 2
+                            for name, filename, opener, size, content_type in files) +
+                        len(self._closing()))
+
+    def _field_part(self, name, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n' % (self.boundary, name)).encode('utf-8') + \
+            value + b'\r\n'
+
+    def _file_header(self, name, filename, content_type):
+        import mimetypes
+        content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n' %
+                (self.boundary, name, filename.replace('"', '%22'), content_type)).encode('utf-8')
+
+    def _closing(self):
+        return ('--%s--\r\n' % self.boundary).encode('utf-8')
+
+    def _generate(self, fields, files):
+        for name, value in fields:
+            yield self._field_part(name, value)
+        for name, filename, opener, size, content_type in files:
+            opened_name, src, close = opener()
+            filename = filename or opened_name
+            try:
+                yield self._file_header(name, filename, content_type)
+                sent = 0
+                while True:
+                    chunk = src.read(self._chunk_size)
+                    if not chunk:
+                        break
+                    sent += len(chunk)
+                    yield chunk
+                    if self._progress:
+                        self._progress(filename, sent, size)
+            finally:
+                close()
+            yield b'\r\n'
+        yield self._closing()
+
+    def read(self, size=-1):
+        out = []
+        while size != 0:
+            if self._pos >= len(self._buffer):
+                self._buffer = next(self._chunks, b'')
+                self._pos = 0
+                if not self._buffer:
+                    break
+            n = len(self._buffer) - self._pos
+            if size > 0:
+                n = min(n, size)
+                size -= n
+            out.append(self._buffer[self._pos:self._pos + n])
+            self._pos += n
+        return b''.join(out)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self._chunk_size)
+            if not chunk:
+                return
+            yield chunk
@@ -0,0 +1,44 @@
+import io
+import json
+
+from SbJson import iter_json_array
+
+
+def _page(count):
+    return json.dumps({'total': count,
+                       'items': [{'id': '%024x' % i, 'title': 'Item %d' % i, 'size': i * 1.5, 'public': i % 2 == 0}
+                                 for i in range(count)],
+                       'nextlink': {'url': 'https://example.com/items?offset=%d' % count}}).encode('utf-8')
+
+
+def test_first_element_before_end_of_stream():
+    page = _page(2000)
+    f = io.BytesIO(page)
+    items = iter_json_array(f, 'items', chunk_size=4096, others={})
+    assert next(items)['id'] == '%024x' % 0
+    assert f.tell() < len(page) // 10
+
+
+def test_matches_json_loads_for_any_chunk_size():
+    page = _page(50)
+    expected = json.loads(page.decode('utf-8'))
+    for chunk_size in (1, 2, 7, 64, 4096):
+        rest = {}
+        assert list(iter_json_array(io.BytesIO(page), 'items', chunk_size, rest)) == expected['items']
+        assert rest == {'total': 50, 'nextlink': expected['nextlink']}
+
+
+def test_numbers_and_literals_split_across_chunks():
+    text = '{"n": 12345.678, "items": [1234567, -0.5e10, true, null, false, "x"], "m": 98765}'
+    for chunk_size in (1, 3, 5):
+        rest = {}
+        assert list(iter_json_array(io.StringIO(text), 'items', chunk_size, rest)) == \
+            [1234567, -0.5e10, True, None, False, 'x']
+        assert rest == {'n': 12345.678, 'm': 98765}
+
+
+def test_empty_array_and_missing_key():
+    assert list(iter_json_array(io.StringIO('{"items": []}'), 'items')) == []
+    feature = {'type': 'Feature', 'geometry': None}
+    assert list(iter_json_array(io.StringIO(json.dumps(feature)), 'features')) == [feature]
+    assert list(iter_json_array(io.StringIO(json.dumps(feature)), 'features', others={})) == []
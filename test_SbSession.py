@@ -0,0 +1,32 @@
+import io
+import json
+
+from SbSession import SbSession
+
+
+def _feature_collection(count):
+    return json.dumps({'type': 'FeatureCollection',
+                       'features': [{'type': 'Feature', 'properties': {'i': i, 'name': 'Feature %d' % i},
+                                     'geometry': {'type': 'Point', 'coordinates': [i * 0.001, 45.0]}}
+                                    for i in range(count)]}).encode('utf-8')
+
+
+def test_iter_geojson_features_reads_file_incrementally():
+    data = _feature_collection(20000)
+    f = io.BytesIO(data)
+    features = SbSession().iter_geojson_features(f)
+    assert next(features)['properties']['i'] == 0
+    assert f.tell() < len(data) // 10
+    assert sum(1 for _ in features) == 19999
+
+
+def test_iter_geojson_features_sources(tmpdir):
+    feature = {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': [0, 0]}}
+    path = str(tmpdir.join('features.json'))
+    with open(path, 'wb') as f:
+        f.write(_feature_collection(3))
+    sb = SbSession()
+    assert [f['properties']['i'] for f in sb.iter_geojson_features(path)] == [0, 1, 2]
+    assert list(sb.iter_geojson_features(feature)) == [feature]
+    assert list(sb.iter_geojson_features({'type': 'FeatureCollection', 'features': [feature]})) == [feature]
+    assert list(sb.iter_geojson_features(io.StringIO(json.dumps(feature)))) == [feature]